@@ -3,8 +3,64 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-MONGO_DB_USER = os.environ.get('MONGO_DB_USER')
-MONGO_DB_PASSWORD = os.environ.get('MONGO_DB_PASSWORD')
-MONGO_DB_CLUSTER_URL = os.environ.get('MONGO_DB_CLUSTER_URL')
-MONGO_DB_APP_NAME = os.environ.get('MONGO_DB_APP_NAME')
-MAX_PAGE_SIZE = os.environ.get('MAX_PAGE_SIZE', 200)
\ No newline at end of file
+MAX_PAGE_SIZE = os.environ.get('MAX_PAGE_SIZE', 200)
+CART_UPDATE_MAX_RETRIES = int(os.environ.get('CART_UPDATE_MAX_RETRIES', 5))
+ENSURE_INDEXES_ON_STARTUP = (
+    os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() == 'true'
+)
+INDEX_REPORT_ON_STARTUP = (
+    os.environ.get('INDEX_REPORT_ON_STARTUP', 'false').lower() == 'true'
+)
+PRODUCT_CACHE_MAX_SIZE = int(os.environ.get('PRODUCT_CACHE_MAX_SIZE', 10000))
+PRODUCT_CACHE_TTL_SECONDS = float(
+    os.environ.get('PRODUCT_CACHE_TTL_SECONDS', 30)
+)
+CHANGE_STREAMS_ENABLED = (
+    os.environ.get('CHANGE_STREAMS_ENABLED', 'false').lower() == 'true'
+)
+CHANGE_STREAM_NAME = os.environ.get('CHANGE_STREAM_NAME', 'cache_invalidation')
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+FAST_JSON_RESPONSES = (
+    os.environ.get('FAST_JSON_RESPONSES', 'false').lower() == 'true'
+)
+BULK_WRITE_CHUNK_SIZE = int(os.environ.get('BULK_WRITE_CHUNK_SIZE', 1000))
+CASCADE_DELETES_IN_TRANSACTION = (
+    os.environ.get('CASCADE_DELETES_IN_TRANSACTION', 'false').lower() == 'true'
+)
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 86400))
+CHECKOUT_IN_TRANSACTION = (
+    os.environ.get('CHECKOUT_IN_TRANSACTION', 'false').lower() == 'true'
+)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+RESERVATION_TTL_SECONDS = int(os.environ.get('RESERVATION_TTL_SECONDS', 900))
+RESERVATION_SWEEP_INTERVAL_SECONDS = float(
+    os.environ.get('RESERVATION_SWEEP_INTERVAL_SECONDS', 30)
+)
+IDEMPOTENCY_ENABLED = (
+    os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+)
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+IDEMPOTENCY_LOCK_SECONDS = float(
+    os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 60)
+)
+IDEMPOTENCY_CACHE_MAX_SIZE = int(
+    os.environ.get('IDEMPOTENCY_CACHE_MAX_SIZE', 10000)
+)
+IDEMPOTENCY_MAX_BODY_BYTES = int(
+    os.environ.get('IDEMPOTENCY_MAX_BODY_BYTES', 1024 * 1024)
+)
+USER_IMPORT_CHUNK_SIZE = int(os.environ.get('USER_IMPORT_CHUNK_SIZE', 1000))
+USER_IMPORT_CONCURRENCY = int(os.environ.get('USER_IMPORT_CONCURRENCY', 4))
+USER_IMPORT_HASH_WORKERS = int(os.environ.get('USER_IMPORT_HASH_WORKERS', 2))
+PRODUCT_CACHE_CONTROL = os.environ.get(
+    'PRODUCT_CACHE_CONTROL',
+    'public, max-age=0, s-maxage=10'
+)
+PRODUCT_LIST_CACHE_CONTROL = os.environ.get(
+    'PRODUCT_LIST_CACHE_CONTROL',
+    'public, max-age=0, s-maxage=10'
+)
@@ -1,15 +1,39 @@
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorCollection
 
+# Projection used when only the existence of an object matters.
+ID_PROJECTION = {"_id": 1}
+# Code of the server error raised when a unique index is violated.
+DUPLICATE_KEY_ERROR = 11000
+
 
 async def delete_obj(collection: AsyncIOMotorCollection, id: str):
     '''Delete object from any collection.'''
     await collection.delete_one({"_id": id})
 
 
-async def find_obj_by_id(collection: AsyncIOMotorCollection, id: str):
-    '''Find object by id in any collection.'''
-    return await collection.find_one({"_id": id})
+async def find_obj_by_id(
+        collection: AsyncIOMotorCollection,
+        id: str,
+        projection: dict = None):
+    '''
+    Find object by id in any collection.
+    If a projection is given, only the projected fields are fetched.
+    '''
+    return await collection.find_one({"_id": id}, projection)
+
+
+async def find_objs_by_ids(
+        collection: AsyncIOMotorCollection,
+        ids: list,
+        projection: dict = None):
+    '''
+    Find many objects by their ids in any collection using a single query.
+    Returns a dict mapping each found id to its object.
+    If a projection is given, only the projected fields are fetched.
+    '''
+    objs = collection.find({"_id": {"$in": list(set(ids))}}, projection)
+    return {obj['_id']: obj async for obj in objs}
 
 
 async def create_obj(collection: AsyncIOMotorCollection, data: dict):
@@ -20,6 +44,14 @@ async def create_obj(collection: AsyncIOMotorCollection, data: dict):
 async def update_obj(
         collection: AsyncIOMotorCollection,
         obj_id: str,
-        new_obj: dict):
-    '''Update object from any collection.'''
-    return await collection.update_one({"_id": obj_id}, {"$set": new_obj})
+        new_obj: dict,
+        increments: dict = None):
+    '''
+    Update object from any collection.
+    If increments are given, those fields are incremented by the same
+    update.
+    '''
+    update = {"$set": new_obj}
+    if increments:
+        update["$inc"] = increments
+    return await collection.update_one({"_id": obj_id}, update)
@@ -0,0 +1,168 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Awaitable, Callable, Hashable, Iterable
+from motor.motor_asyncio import AsyncIOMotorCollection
+from api.constants import PRODUCT_CACHE_MAX_SIZE, PRODUCT_CACHE_TTL_SECONDS
+from api.db.actions import find_objs_by_ids
+
+
+class AsyncLRUCache:
+    '''
+    Bounded in-process cache with LRU and TTL eviction, meant to be shared
+    by the coroutines of one event loop. Concurrent misses on the same key
+    are coalesced into a single in-flight load, and a load that was running
+    when its key got invalidated never stores its (possibly stale) result.
+    Cached values are shared between callers and must not be mutated.
+    '''
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loads = {}
+
+    async def get(
+            self,
+            key: Hashable,
+            load_many: Callable[[list], Awaitable[dict]]):
+        '''Get a single value, loading it on a miss.'''
+        values = await self.get_many([key], load_many)
+        return values.get(key)
+
+    async def get_many(
+            self,
+            keys: Iterable[Hashable],
+            load_many: Callable[[list], Awaitable[dict]]) -> dict:
+        '''
+        Get many values at once. All keys that are neither cached nor
+        being loaded are fetched with a single call to load_many, which
+        must return a dict with the values found for the given keys.
+        Keys without a value are cached as missing too.
+        '''
+        now = monotonic()
+        values = {}
+        missing_keys = []
+        for key in dict.fromkeys(keys):
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                values[key] = entry[1]
+            else:
+                self.misses += 1
+                missing_keys.append(key)
+
+        keys_to_load = [key for key in missing_keys if key not in self._loads]
+        if keys_to_load:
+            load = asyncio.ensure_future(
+                self._load(keys_to_load, load_many)
+            )
+            for key in keys_to_load:
+                self._loads[key] = load
+
+        loads = {self._loads[key] for key in missing_keys}
+        for loaded_values in await asyncio.gather(
+                *(asyncio.shield(load) for load in loads)):
+            for key in missing_keys:
+                if key in loaded_values:
+                    values[key] = loaded_values[key]
+
+        return {
+            key: value for key, value in values.items() if value is not None
+        }
+
+    def invalidate(self, key: Hashable):
+        '''Drop a key, including any load of it which is still running.'''
+        self._entries.pop(key, None)
+        self._loads.pop(key, None)
+
+    def clear(self):
+        '''Drop every key.'''
+        self._entries.clear()
+        self._loads.clear()
+
+    def stats(self) -> dict:
+        '''Hit and miss counters of the cache.'''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_size
+        }
+
+    async def _load(
+            self,
+            keys: list,
+            load_many: Callable[[list], Awaitable[dict]]) -> dict:
+        load = asyncio.current_task()
+        try:
+            loaded_values = await load_many(keys)
+        finally:
+            owned_keys = [
+                key for key in keys if self._loads.get(key) is load
+            ]
+            for key in owned_keys:
+                del self._loads[key]
+
+        expires_at = monotonic() + self.ttl_seconds
+        for key in owned_keys:
+            self._entries[key] = (expires_at, loaded_values.get(key))
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return {key: loaded_values.get(key) for key in keys}
+
+
+# Every product read through products_cache must use this projection,
+# since the cached documents only hold these fields.
+PRODUCT_CACHE_PROJECTION = {
+    'name': 1,
+    'theme': 1,
+    'price': 1,
+    'quantity': 1,
+    'version': 1
+}
+
+products_cache = AsyncLRUCache(
+    max_size=PRODUCT_CACHE_MAX_SIZE,
+    ttl_seconds=PRODUCT_CACHE_TTL_SECONDS
+)
+
+
+async def find_cached_obj_by_id(
+        cache: AsyncLRUCache,
+        collection: AsyncIOMotorCollection,
+        id,
+        projection: dict = None):
+    '''
+    Find object by id in any collection, going through the given cache.
+    The projection must be the same for every read of a cache.
+    '''
+    return await cache.get(
+        id,
+        lambda ids: find_objs_by_ids(collection, ids, projection)
+    )
+
+
+async def find_cached_objs_by_ids(
+        cache: AsyncLRUCache,
+        collection: AsyncIOMotorCollection,
+        ids: list,
+        projection: dict = None):
+    '''
+    Find many objects by their ids in any collection, going through the
+    given cache. Only the ids missing from the cache are queried.
+    The projection must be the same for every read of a cache.
+    '''
+    return await cache.get_many(
+        ids,
+        lambda missing_ids: find_objs_by_ids(
+            collection,
+            missing_ids,
+            projection
+        )
+    )
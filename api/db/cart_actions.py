@@ -0,0 +1,333 @@
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class CartVersionConflict(Exception):
+    '''Raised when a shopping cart changed between its read and its update.'''
+
+
+# Pipeline stage recomputing the denormalized totals of a shopping cart
+# from its lines. Lines without a unit price snapshot count as free.
+CART_TOTALS_STAGE = {"$set": {
+    "item_count": {"$sum": "$products.quantity"},
+    "subtotal": {"$sum": {"$map": {
+        "input": "$products",
+        "as": "line",
+        "in": {"$multiply": [
+            "$$line.quantity",
+            {"$ifNull": ["$$line.unit_price", 0]}
+        ]}
+    }}}
+}}
+EMPTY_CART_FIELDS = {"products": [], "item_count": 0, "subtotal": 0.0}
+
+
+def lazy_cart(user_id: ObjectId) -> dict:
+    '''
+    The own shopping cart of a user before it is stored. It shares the
+    id of the user and is only stored by the first update adding items
+    to it, so users who never shop don't get a cart document.
+    '''
+    return {
+        "_id": user_id,
+        "user_id": user_id,
+        "products": [],
+        "item_count": 0,
+        "subtotal": 0.0,
+        "lazy": True
+    }
+
+
+async def find_cart(
+        collection: AsyncIOMotorCollection,
+        users_collection: AsyncIOMotorCollection,
+        cart_id: ObjectId,
+        projection: dict = None):
+    '''
+    Find a shopping cart by its id. When no cart is stored under the id
+    of an existing user, the lazy cart of that user is returned instead.
+    Returns None if neither the cart nor the user exist.
+    '''
+    shopping_cart = await collection.find_one({"_id": cart_id}, projection)
+    if shopping_cart is not None:
+        return shopping_cart
+
+    user = await users_collection.find_one({"_id": cart_id}, {"_id": 1})
+    return lazy_cart(cart_id) if user is not None else None
+
+
+def version_filter(shopping_cart: dict) -> dict:
+    '''Filter matching a shopping cart only at the version it was read.'''
+    version = shopping_cart.get('version')
+    if version is None:
+        return {"_id": shopping_cart['_id'], "version": {"$exists": False}}
+    return {"_id": shopping_cart['_id'], "version": version}
+
+
+def build_cart_update(
+        shopping_cart: dict,
+        quantity_changes: dict[ObjectId, int],
+        unit_prices: dict[ObjectId, float]):
+    '''
+    Build the update applying quantity changes (product_id -> delta) to a
+    shopping cart as it was read. Lines already in the cart are changed
+    with $inc, lines dropping to zero units are removed with $pull and new
+    lines are appended with $push, with a snapshot of their unit price
+    taken from unit_prices, so only the changes are sent over the wire.
+    The item count and subtotal of the cart are moved by the same deltas.
+    MongoDB refuses to combine these operators on the same array in one
+    update, so a mix of them is expressed as an equivalent pipeline.
+    Returns a tuple with the update and its array filters.
+    '''
+    lines_in_cart = {
+        product_in_cart['product_id']: product_in_cart
+        for product_in_cart in shopping_cart['products']
+    }
+    increments = {}
+    removed_ids = []
+    new_lines = []
+    item_count_delta = 0
+    subtotal_delta = 0.0
+    for product_id, delta in quantity_changes.items():
+        if delta == 0:
+            continue
+        line = lines_in_cart.get(product_id)
+        if line is None:
+            unit_price = unit_prices[product_id]
+            new_lines.append({
+                'product_id': product_id,
+                'quantity': delta,
+                'unit_price': unit_price
+            })
+        else:
+            unit_price = line.get('unit_price')
+            if unit_price is None:
+                unit_price = 0
+            if line['quantity'] + delta == 0:
+                removed_ids.append(product_id)
+            else:
+                increments[product_id] = delta
+        item_count_delta += delta
+        subtotal_delta += delta * unit_price
+
+    version_increment = {
+        "version": 1,
+        "item_count": item_count_delta,
+        "subtotal": subtotal_delta
+    }
+    changed_kinds = sum(map(bool, (increments, removed_ids, new_lines)))
+
+    if changed_kinds == 0:
+        return {"$inc": {"version": 1}}, None
+
+    if changed_kinds == 1 and increments:
+        inc = dict(version_increment)
+        array_filters = []
+        for index, (product_id, delta) in enumerate(increments.items()):
+            inc[f"products.$[p{index}].quantity"] = delta
+            array_filters.append({f"p{index}.product_id": product_id})
+        return {"$inc": inc}, array_filters
+
+    if changed_kinds == 1 and removed_ids:
+        update = {
+            "$pull": {"products": {"product_id": {"$in": removed_ids}}},
+            "$inc": version_increment
+        }
+        return update, None
+
+    if changed_kinds == 1:
+        update = {
+            "$push": {"products": {"$each": new_lines}},
+            "$inc": version_increment
+        }
+        return update, None
+
+    deltas = dict(increments)
+    for product_id in removed_ids:
+        deltas[product_id] = -lines_in_cart[product_id]['quantity']
+    delta_for_line = {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$$line.product_id", product_id]}, "then": delta}
+            for product_id, delta in deltas.items()
+        ],
+        "default": 0
+    }}
+    changed_lines = {
+        "$map": {
+            "input": {"$ifNull": ["$products", []]},
+            "as": "line",
+            "in": {
+                "product_id": "$$line.product_id",
+                "quantity": {"$add": ["$$line.quantity", delta_for_line]},
+                "unit_price": "$$line.unit_price"
+            }
+        }
+    }
+    update = [{"$set": {
+        "products": {"$concatArrays": [
+            {"$filter": {
+                "input": changed_lines,
+                "as": "line",
+                "cond": {"$gt": ["$$line.quantity", 0]}
+            }},
+            new_lines
+        ]},
+        "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+        "item_count": {
+            "$add": [{"$ifNull": ["$item_count", 0]}, item_count_delta]
+        },
+        "subtotal": {"$add": [{"$ifNull": ["$subtotal", 0]}, subtotal_delta]}
+    }}]
+    return update, None
+
+
+async def apply_cart_changes(
+        collection: AsyncIOMotorCollection,
+        shopping_cart: dict,
+        quantity_changes: dict[ObjectId, int],
+        unit_prices: dict[ObjectId, float]):
+    '''
+    Apply quantity changes to a shopping cart in a single round trip.
+    The update only matches the version of the cart that was read, so
+    CartVersionConflict is raised instead of losing a concurrent update.
+    A lazy cart is stored by the same update, with an upsert, unless
+    there is nothing to change, in which case it is returned unstored.
+    '''
+    upsert = shopping_cart.get('lazy', False)
+    if upsert and not any(quantity_changes.values()):
+        return shopping_cart
+
+    update, array_filters = build_cart_update(
+        shopping_cart,
+        quantity_changes,
+        unit_prices
+    )
+    if upsert and isinstance(update, list):
+        update.append({"$set": {
+            "user_id": {"$ifNull": ["$user_id", shopping_cart['user_id']]}
+        }})
+    elif upsert:
+        update["$setOnInsert"] = {"user_id": shopping_cart['user_id']}
+    try:
+        updated_cart = await collection.find_one_and_update(
+            version_filter(shopping_cart),
+            update,
+            array_filters=array_filters,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Another request stored the lazy cart first.
+        updated_cart = None
+    if updated_cart is None:
+        raise CartVersionConflict(shopping_cart['_id'])
+
+    return updated_cart
+
+
+async def find_cart_with_products(
+        collection: AsyncIOMotorCollection,
+        cart_id: ObjectId,
+        products_collection_name: str) -> dict:
+    '''
+    Find a shopping cart along with the name, price and stock of the
+    products in it, joined by the database with a single $lookup.
+    The products are returned in a product_docs list, in no particular
+    order. Returns None if the cart doesn't exist.
+    '''
+    pipeline = [
+        {"$match": {"_id": cart_id}},
+        {"$lookup": {
+            "from": products_collection_name,
+            "localField": "products.product_id",
+            "foreignField": "_id",
+            "as": "product_docs"
+        }},
+        {"$project": {
+            "user_id": 1,
+            "products": 1,
+            "product_docs._id": 1,
+            "product_docs.name": 1,
+            "product_docs.price": 1,
+            "product_docs.quantity": 1
+        }}
+    ]
+    carts = await collection.aggregate(pipeline).to_list(length=1)
+    return carts[0] if carts else None
+
+
+async def clear_cart(collection: AsyncIOMotorCollection, cart_id: ObjectId):
+    '''
+    Remove all items from a shopping cart in a single round trip.
+    Returns the updated shopping cart or None if it doesn't exist.
+    '''
+    return await collection.find_one_and_update(
+        {"_id": cart_id},
+        {"$set": EMPTY_CART_FIELDS, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def remove_products_from_carts(
+        collection: AsyncIOMotorCollection,
+        product_ids: list,
+        session=None):
+    '''
+    Remove the given products from every shopping cart holding them
+    with a single update, bumping the version and recomputing the totals
+    of the changed carts.
+    '''
+    return await collection.update_many(
+        {"products.product_id": {"$in": product_ids}},
+        [
+            {"$set": {
+                "products": {"$filter": {
+                    "input": "$products",
+                    "as": "line",
+                    "cond": {
+                        "$not": {"$in": ["$$line.product_id", product_ids]}
+                    }
+                }},
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+            }},
+            CART_TOTALS_STAGE
+        ],
+        session=session
+    )
+
+
+async def update_cart_prices(
+        collection: AsyncIOMotorCollection,
+        unit_prices: dict[ObjectId, float]):
+    '''
+    Refresh the unit price snapshots of the given products (product_id
+    -> new price) in every shopping cart holding them, with a single
+    update bumping the version and recomputing the totals of those carts.
+    '''
+    new_unit_price = {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$$line.product_id", product_id]}, "then": price}
+            for product_id, price in unit_prices.items()
+        ],
+        "default": "$$line.unit_price"
+    }}
+    return await collection.update_many(
+        {"products.product_id": {"$in": list(unit_prices)}},
+        [
+            {"$set": {
+                "products": {"$map": {
+                    "input": "$products",
+                    "as": "line",
+                    "in": {
+                        "product_id": "$$line.product_id",
+                        "quantity": "$$line.quantity",
+                        "unit_price": new_unit_price
+                    }
+                }},
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+            }},
+            CART_TOTALS_STAGE
+        ]
+    )
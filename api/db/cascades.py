@@ -0,0 +1,75 @@
+from typing import Awaitable, Callable
+from bson import ObjectId
+from api.constants import CASCADE_DELETES_IN_TRANSACTION
+from api.db.actions import ID_PROJECTION
+from api.db.cart_actions import remove_products_from_carts
+from api.db.reservations import drop_product_reservations, release_carts
+from api.db.settings import mongo
+
+
+async def delete_user_cascade(user_id: ObjectId, session=None) -> bool:
+    '''
+    Delete a user and all of its shopping carts with one statement each,
+    giving back the stock held by those carts.
+    Returns False if the user doesn't exist.
+    '''
+    result = await mongo.users_collection.delete_one(
+        {"_id": user_id},
+        session=session
+    )
+    if result.deleted_count == 0:
+        return False
+
+    shopping_carts = mongo.shopping_carts_collection.find(
+        {"user_id": user_id},
+        ID_PROJECTION,
+        session=session
+    )
+    cart_ids = {shopping_cart['_id'] async for shopping_cart in shopping_carts}
+    # The own cart of the user shares its id and may hold stock before
+    # it is stored.
+    cart_ids.add(user_id)
+    await mongo.shopping_carts_collection.delete_many(
+        {"user_id": user_id},
+        session=session
+    )
+    await release_carts(list(cart_ids), session=session)
+    return True
+
+
+async def delete_product_cascade(product_id: ObjectId, session=None) -> bool:
+    '''
+    Delete a product, pull it from every shopping cart and drop the
+    holds on it with one statement each.
+    Returns False if the product doesn't exist.
+    '''
+    result = await mongo.products_collection.delete_one(
+        {"_id": product_id},
+        session=session
+    )
+    if result.deleted_count == 0:
+        return False
+
+    await remove_products_from_carts(
+        mongo.shopping_carts_collection,
+        [product_id],
+        session=session
+    )
+    await drop_product_reservations([product_id], session=session)
+    return True
+
+
+async def run_cascade(
+        cascade: Callable[..., Awaitable[bool]],
+        id: ObjectId) -> bool:
+    '''
+    Run a cascade delete, inside a transaction when
+    CASCADE_DELETES_IN_TRANSACTION is enabled (requires a replica set).
+    '''
+    if not CASCADE_DELETES_IN_TRANSACTION:
+        return await cascade(id)
+
+    async with await mongo.client.start_session() as session:
+        return await session.with_transaction(
+            lambda session: cascade(id, session=session)
+        )
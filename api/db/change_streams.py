@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from time import monotonic
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import OperationFailure, PyMongoError
+from api.db.cache import AsyncLRUCache
+
+logger = logging.getLogger(__name__)
+
+# Server errors meaning a resume token can't be used anymore, e.g. because
+# it fell out of the oplog window (ChangeStreamHistoryLost).
+UNRESUMABLE_ERROR_CODES = {260, 280, 286}
+CACHE_RESETTING_OPERATIONS = {'drop', 'rename', 'dropDatabase', 'invalidate'}
+
+
+class ResumeTokenStore:
+    '''Keeps the resume token of a change stream in memory.'''
+
+    def __init__(self):
+        self.token = None
+
+    async def load(self):
+        '''Return the last saved resume token, if any.'''
+        return self.token
+
+    async def save(self, token):
+        '''Save the resume token of the last processed change.'''
+        self.token = token
+
+
+class MongoResumeTokenStore(ResumeTokenStore):
+    '''Persists the resume token of a change stream in a collection.'''
+
+    def __init__(self, collection: AsyncIOMotorCollection, stream_name: str):
+        super().__init__()
+        self.collection = collection
+        self.stream_name = stream_name
+
+    async def load(self):
+        document = await self.collection.find_one({'_id': self.stream_name})
+        if document is not None:
+            self.token = document['token']
+        return self.token
+
+    async def save(self, token):
+        self.token = token
+        await self.collection.update_one(
+            {'_id': self.stream_name},
+            {'$set': {'token': token}},
+            upsert=True
+        )
+
+
+def apply_change(caches: dict[str, AsyncLRUCache], change: dict):
+    '''Evict from the local caches whatever the given change made stale.'''
+    cache = caches.get(change.get('ns', {}).get('coll'))
+    operation = change['operationType']
+
+    if operation in CACHE_RESETTING_OPERATIONS:
+        for cache_to_reset in ([cache] if cache else caches.values()):
+            cache_to_reset.clear()
+    elif cache is not None and 'documentKey' in change:
+        cache.invalidate(change['documentKey']['_id'])
+
+
+async def watch_cache_invalidations(
+        db,
+        caches: dict[str, AsyncLRUCache],
+        token_store: ResumeTokenStore,
+        save_interval_seconds: float = 1.0,
+        retry_delay_seconds: float = 1.0):
+    '''
+    Tail a change stream on the collections backing the given caches
+    (collection name -> cache) and evict the entries changed by any
+    process, so several workers never serve each other's stale data.
+    The stream resumes from the token kept by token_store, which is saved
+    at most once per save_interval_seconds. If the token can't be used
+    anymore, the caches are cleared and the stream starts over.
+    Only db.watch() is used, so an in-memory fake can stand in for Motor.
+    Runs until cancelled.
+    '''
+    pipeline = [{'$match': {'ns.coll': {'$in': list(caches)}}}]
+    resume_token = await token_store.load()
+    saved_token = resume_token
+    last_save = monotonic()
+
+    try:
+        while True:
+            try:
+                async with db.watch(
+                        pipeline,
+                        resume_after=resume_token) as stream:
+                    async for change in stream:
+                        apply_change(caches, change)
+                        resume_token = stream.resume_token
+                        if change['operationType'] == 'invalidate':
+                            resume_token = None
+                            break
+
+                        if monotonic() - last_save >= save_interval_seconds:
+                            await token_store.save(resume_token)
+                            saved_token = resume_token
+                            last_save = monotonic()
+            except OperationFailure as error:
+                if error.code not in UNRESUMABLE_ERROR_CODES:
+                    logger.exception('Change stream stopped')
+                    raise
+                logger.warning('Change stream history lost, clearing caches')
+                for cache in caches.values():
+                    cache.clear()
+                resume_token = None
+            except PyMongoError:
+                logger.exception('Change stream failed, resuming')
+                await asyncio.sleep(retry_delay_seconds)
+    finally:
+        if resume_token != saved_token:
+            await token_store.save(resume_token)
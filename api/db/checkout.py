@@ -0,0 +1,154 @@
+import asyncio
+from pymongo import UpdateOne
+from api.constants import CHECKOUT_IN_TRANSACTION
+from api.db.actions import find_objs_by_ids
+from api.db.cart_actions import (
+    EMPTY_CART_FIELDS,
+    CartVersionConflict,
+    version_filter
+)
+from api.db.reservations import (
+    InsufficientStock,
+    available_filter,
+    claim_cart_reservations,
+    restore_cart_reservations
+)
+from api.db.settings import mongo
+
+
+def _reserve_line(line: dict, held: int) -> tuple[dict, dict]:
+    '''
+    Conditional update taking the units of a cart line from the stock.
+    The held units were reserved by the cart, so only the rest of the
+    line needs to be available.
+    '''
+    return (
+        available_filter(line['product_id'], line['quantity'] - held),
+        {"$inc": {
+            "quantity": -line['quantity'],
+            "reserved": -held,
+            "version": 1
+        }}
+    )
+
+
+def _release_line(line: dict, held: int) -> tuple[dict, dict]:
+    '''Update giving the units of a cart line back to the stock.'''
+    return (
+        {"_id": line['product_id']},
+        {"$inc": {
+            "quantity": line['quantity'],
+            "reserved": held,
+            "version": 1
+        }}
+    )
+
+
+def _clear_cart(shopping_cart: dict) -> tuple[dict, dict]:
+    '''Update emptying the shopping cart, if it's still at the read version.'''
+    return (
+        version_filter(shopping_cart),
+        {"$set": EMPTY_CART_FIELDS, "$inc": {"version": 1}}
+    )
+
+
+async def _find_short_lines(lines: list, held: dict) -> list:
+    products = await find_objs_by_ids(
+        mongo.products_collection,
+        [line['product_id'] for line in lines],
+        {"quantity": 1, "reserved": 1}
+    )
+    short_lines = []
+    for line in lines:
+        product = products.get(line['product_id'], {})
+        available = (
+            product.get('quantity', 0) - product.get('reserved', 0)
+            + held.get(line['product_id'], 0)
+        )
+        if available < line['quantity']:
+            short_lines.append(line['product_id'])
+    return short_lines
+
+
+async def _checkout_in_transaction(shopping_cart: dict, session):
+    lines = shopping_cart['products']
+    held = await claim_cart_reservations(
+        shopping_cart['_id'],
+        session=session
+    )
+    result = await mongo.products_collection.bulk_write(
+        [
+            UpdateOne(*_reserve_line(line, held.get(line['product_id'], 0)))
+            for line in lines
+        ],
+        ordered=False,
+        session=session
+    )
+    if result.matched_count < len(lines):
+        raise InsufficientStock(await _find_short_lines(lines, held))
+
+    result = await mongo.shopping_carts_collection.update_one(
+        *_clear_cart(shopping_cart),
+        session=session
+    )
+    if result.matched_count == 0:
+        raise CartVersionConflict(shopping_cart['_id'])
+
+
+async def _checkout_with_compensation(shopping_cart: dict):
+    lines = shopping_cart['products']
+    held = await claim_cart_reservations(shopping_cart['_id'])
+    held_per_line = [held.get(line['product_id'], 0) for line in lines]
+    results = await asyncio.gather(*(
+        mongo.products_collection.update_one(*_reserve_line(line, line_held))
+        for line, line_held in zip(lines, held_per_line)
+    ))
+    reserved_lines = [
+        (line, line_held)
+        for line, line_held, result in zip(lines, held_per_line, results)
+        if result.matched_count
+    ]
+
+    failure = None
+    if len(reserved_lines) < len(lines):
+        failure = InsufficientStock([
+            line['product_id'] for line, result in zip(lines, results)
+            if not result.matched_count
+        ])
+    else:
+        result = await mongo.shopping_carts_collection.update_one(
+            *_clear_cart(shopping_cart)
+        )
+        if result.matched_count == 0:
+            failure = CartVersionConflict(shopping_cart['_id'])
+
+    if failure is not None:
+        await asyncio.gather(*(
+            mongo.products_collection.update_one(
+                *_release_line(line, line_held)
+            )
+            for line, line_held in reserved_lines
+        ))
+        await restore_cart_reservations(shopping_cart['_id'], held)
+        raise failure
+
+
+async def checkout_cart(shopping_cart: dict):
+    '''
+    Take the units of every line of a shopping cart from the stock and
+    empty the cart. The units held by the cart are turned into sales, and
+    the rest of each line is taken with a conditional $inc that only
+    matches while enough units are neither sold nor held by other carts,
+    so concurrent checkouts can never oversell. With
+    CHECKOUT_IN_TRANSACTION (requires a replica set) all writes run
+    inside a transaction; otherwise they are sent concurrently and undone
+    if the checkout fails. Raises InsufficientStock with the short
+    products, or CartVersionConflict if the cart changed meanwhile.
+    '''
+    if not CHECKOUT_IN_TRANSACTION:
+        return await _checkout_with_compensation(shopping_cart)
+
+    async with await mongo.client.start_session() as session:
+        await session.with_transaction(
+            lambda session: _checkout_in_transaction(shopping_cart, session)
+        )
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import sys
+
+sys.path.append('..')
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, TEXT, IndexModel
+from api.constants import JOB_RETENTION_SECONDS
+from api.enums import SortableProductFields
+
+
+def _product_indexes() -> list:
+    '''
+    Indexes serving every sort of GET /api/products/, with and without the
+    theme filter, and the text search on names. The _id is the sort
+    tiebreaker used by the pagination, and descending sorts walk the same
+    indexes backwards. The products holding stock are indexed too, for
+    the reservation sweeper.
+    '''
+    sortable_keys = [
+        field.value for field in SortableProductFields
+        if field not in (SortableProductFields.ID, SortableProductFields.THEME)
+    ]
+    indexes = [
+        IndexModel([('theme', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('name', TEXT)]),
+        IndexModel(
+            [('reserved', ASCENDING)],
+            partialFilterExpression={'reserved': {'$gt': 0}}
+        )
+    ]
+    for key in sortable_keys:
+        indexes.append(IndexModel([(key, ASCENDING), ('_id', ASCENDING)]))
+        indexes.append(IndexModel([
+            ('theme', ASCENDING),
+            (key, ASCENDING),
+            ('_id', ASCENDING)
+        ]))
+    return indexes
+
+
+INDEXES = {
+    'products_data': _product_indexes(),
+    'shopping_carts_data': [
+        IndexModel([('user_id', ASCENDING)]),
+        IndexModel([('products.product_id', ASCENDING)])
+    ],
+    'reservations_data': [
+        IndexModel(
+            [('cart_id', ASCENDING), ('product_id', ASCENDING)],
+            unique=True
+        ),
+        IndexModel([('product_id', ASCENDING)]),
+        # Not a TTL index: deleting a hold must also release its units,
+        # which only the sweeper does.
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_sweep')
+    ],
+    'jobs_data': [
+        IndexModel(
+            [('created_at', ASCENDING)],
+            expireAfterSeconds=JOB_RETENTION_SECONDS
+        )
+    ],
+    'idempotency_keys_data': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0)
+    ]
+}
+
+
+# Indexes created by earlier versions, which must not exist anymore.
+OBSOLETE_INDEXES = {
+    # TTL index deleting expired holds without releasing their units.
+    'reservations_data': ['expires_at_1']
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    '''
+    Drop the obsolete indexes and create all declared indexes that don't
+    exist yet.
+    '''
+    for collection_name, names in OBSOLETE_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection_name].drop_index(name)
+
+    for collection_name, indexes in INDEXES.items():
+        await db[collection_name].create_indexes(indexes)
+
+
+async def index_report(db: AsyncIOMotorDatabase) -> dict:
+    '''
+    Compare the declared indexes with the existing ones. For each
+    collection it lists the declared indexes that are missing, the
+    existing indexes that are not declared and the existing indexes
+    that were never used since the server started.
+    '''
+    report = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        declared = {index.document['name'] for index in indexes}
+        existing = set(await collection.index_information())
+        existing.discard('_id_')
+
+        usage = collection.aggregate([{'$indexStats': {}}])
+        unused = {
+            stats['name'] async for stats in usage
+            if stats['accesses']['ops'] == 0 and stats['name'] != '_id_'
+        }
+
+        report[collection_name] = {
+            'missing': sorted(declared - existing),
+            'undeclared': sorted(existing - declared),
+            'unused': sorted(unused)
+        }
+
+    return report
+
+
+def format_index_report(report: dict) -> str:
+    '''Render an index report as readable text.'''
+    lines = []
+    for collection_name, sections in report.items():
+        lines.append(f'{collection_name}:')
+        for section, names in sections.items():
+            lines.append(f'  {section}: {", ".join(names) or "-"}')
+    return '\n'.join(lines)
+
+
+async def main(create: bool):
+    from api.db.settings import mongo
+
+    if create:
+        await ensure_indexes(mongo.db)
+    print(format_index_report(await index_report(mongo.db)))
+    mongo.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Report missing, undeclared and unused MongoDB indexes.'
+    )
+    parser.add_argument(
+        '--create',
+        action='store_true',
+        help='create the missing indexes before reporting'
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.create))
@@ -0,0 +1,43 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Awaitable
+from bson import ObjectId
+from api.db.settings import mongo
+from api.enums import JobStatus
+
+# Keeps a reference to the running jobs, so they aren't garbage collected.
+_running_jobs = set()
+
+
+async def _run_job(job_id: ObjectId, job: Awaitable):
+    try:
+        result = await job
+    except Exception as error:
+        update = {"status": JobStatus.FAILED.value, "error": str(error)}
+    else:
+        update = {"status": JobStatus.SUCCEEDED.value, "result": result}
+
+    update["finished_at"] = datetime.now(timezone.utc)
+    await mongo.jobs_collection.update_one({"_id": job_id}, {"$set": update})
+
+
+async def start_job(kind: str, target_id: ObjectId, job: Awaitable) -> str:
+    '''
+    Record a background job and start running it in this process.
+    Its status is kept in the jobs collection, so any worker can report it.
+    Returns the job identifier.
+    '''
+    job_id = ObjectId()
+    await mongo.jobs_collection.insert_one({
+        "_id": job_id,
+        "kind": kind,
+        "target_id": target_id,
+        "status": JobStatus.RUNNING.value,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+    task = asyncio.create_task(_run_job(job_id, job))
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+
+    return str(job_id)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 from api.enums import ProductType
@@ -25,7 +25,20 @@ class ProductInCart(BaseModel):
     quantity: int
 
 
+class CartLine(ProductInCart):
+    '''
+    CartLine model with its attributes, a product in a shopping cart
+    along with a snapshot of its unit price.
+    '''
+    unit_price: Optional[float] = None
+
+
 class ShoppingCart(BaseModel):
-    '''ShoppingCart model with its attributes.'''
+    '''
+    ShoppingCart model with its attributes. The item count and subtotal
+    are kept up to date by every change to the lines or their prices.
+    '''
     user_id: str
-    products: List[ProductInCart]
+    products: List[CartLine]
+    item_count: int = 0
+    subtotal: float = 0.0
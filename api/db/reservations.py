@@ -0,0 +1,304 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from api.constants import RESERVATION_TTL_SECONDS
+from api.db.settings import mongo
+
+logger = logging.getLogger(__name__)
+
+# Holds claimed longer ago than this were left behind by a claimer which
+# died before removing them, and can be claimed again.
+CLAIM_TIMEOUT_SECONDS = 60
+
+
+class InsufficientStock(Exception):
+    '''Raised when some products don't have enough stock available.'''
+
+    def __init__(self, product_ids: list):
+        super().__init__(product_ids)
+        self.product_ids = product_ids
+
+
+def available_filter(product_id: ObjectId, quantity: int) -> dict:
+    '''
+    Filter matching a product only while at least quantity units of it
+    are neither sold nor held by a shopping cart.
+    '''
+    return {
+        "_id": product_id,
+        "$expr": {"$gte": [
+            {"$subtract": ["$quantity", {"$ifNull": ["$reserved", 0]}]},
+            quantity
+        ]}
+    }
+
+
+def _expires_at() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(
+        seconds=RESERVATION_TTL_SECONDS
+    )
+
+
+async def _release_counters(released: dict[ObjectId, int], session=None):
+    updates = [
+        UpdateOne({"_id": product_id}, {"$inc": {"reserved": -quantity}})
+        for product_id, quantity in released.items() if quantity
+    ]
+    if updates:
+        await mongo.products_collection.bulk_write(
+            updates,
+            ordered=False,
+            session=session
+        )
+
+
+async def reserve(cart_id: ObjectId, quantities: dict[ObjectId, int]):
+    '''
+    Hold units of products (product_id -> units) for a shopping cart.
+    The reserved counter of each product is raised with a conditional
+    update, which only matches while enough units are available, so two
+    carts can never hold the same unit. The holds are recorded in the
+    reservations ledger and expire after RESERVATION_TTL_SECONDS.
+    Raises InsufficientStock, holding nothing, if a product is short.
+    '''
+    quantities = {
+        product_id: quantity
+        for product_id, quantity in quantities.items() if quantity > 0
+    }
+    results = await asyncio.gather(*(
+        mongo.products_collection.update_one(
+            available_filter(product_id, quantity),
+            {"$inc": {"reserved": quantity}}
+        )
+        for product_id, quantity in quantities.items()
+    ))
+    reserved = {
+        product_id: quantity
+        for (product_id, quantity), result in zip(quantities.items(), results)
+        if result.matched_count
+    }
+    if len(reserved) < len(quantities):
+        await _release_counters(reserved)
+        raise InsufficientStock([
+            product_id for product_id in quantities
+            if product_id not in reserved
+        ])
+
+    if reserved:
+        await mongo.reservations_collection.bulk_write([
+            UpdateOne(
+                {"cart_id": cart_id, "product_id": product_id},
+                {
+                    "$inc": {"quantity": quantity},
+                    "$set": {"expires_at": _expires_at()}
+                },
+                upsert=True
+            )
+            for product_id, quantity in reserved.items()
+        ], ordered=False)
+
+
+async def _take_from_ledger(
+        cart_id: ObjectId,
+        product_id: ObjectId,
+        quantity: int) -> int:
+    reservation = await mongo.reservations_collection.find_one_and_update(
+        {
+            "cart_id": cart_id,
+            "product_id": product_id,
+            "quantity": {"$gt": quantity},
+            "claim": {"$exists": False}
+        },
+        {"$inc": {"quantity": -quantity}},
+        return_document=ReturnDocument.AFTER
+    )
+    if reservation is not None:
+        return quantity
+
+    reservation = await mongo.reservations_collection.find_one_and_delete(
+        {
+            "cart_id": cart_id,
+            "product_id": product_id,
+            "claim": {"$exists": False}
+        }
+    )
+    return reservation['quantity'] if reservation is not None else 0
+
+
+async def release(cart_id: ObjectId, quantities: dict[ObjectId, int]):
+    '''
+    Give back units of products (product_id -> units) held by a shopping
+    cart. Only units still in the ledger are given back, so holds which
+    already expired are never released twice.
+    '''
+    product_ids = [
+        product_id for product_id, quantity in quantities.items()
+        if quantity > 0
+    ]
+    released = await asyncio.gather(*(
+        _take_from_ledger(cart_id, product_id, quantities[product_id])
+        for product_id in product_ids
+    ))
+    await _release_counters(dict(zip(product_ids, released)))
+
+
+async def _claim_holds(query: dict, session=None) -> dict[ObjectId, int]:
+    '''
+    Remove the holds matching query from the ledger with three statements,
+    however many there are. The holds are stamped with a claim token, so
+    concurrent claimers never take the same hold, then read back and
+    deleted by that token. Returns the units that were held per product.
+    '''
+    collection = mongo.reservations_collection
+    claim = ObjectId()
+    stale_claim = ObjectId.from_datetime(
+        claim.generation_time - timedelta(seconds=CLAIM_TIMEOUT_SECONDS)
+    )
+    await collection.update_many(
+        {"$and": [query, {"$or": [
+            {"claim": {"$exists": False}},
+            {"claim": {"$lt": stale_claim}}
+        ]}]},
+        {"$set": {"claim": claim}},
+        session=session
+    )
+    reservations = await collection.find(
+        {"claim": claim},
+        {"product_id": 1, "quantity": 1},
+        session=session
+    ).to_list(length=None)
+    if not reservations:
+        return {}
+
+    await collection.delete_many({"claim": claim}, session=session)
+    held = {}
+    for reservation in reservations:
+        held[reservation['product_id']] = (
+            held.get(reservation['product_id'], 0) + reservation['quantity']
+        )
+    return held
+
+
+async def claim_cart_reservations(
+        cart_id: ObjectId,
+        session=None) -> dict[ObjectId, int]:
+    '''
+    Remove every hold of a shopping cart from the ledger, leaving the
+    reserved counters untouched. Returns the units that were held per
+    product, which the caller must either sell or release.
+    '''
+    return await _claim_holds({"cart_id": cart_id}, session=session)
+
+
+async def restore_cart_reservations(
+        cart_id: ObjectId,
+        held: dict[ObjectId, int]):
+    '''Put holds taken by claim_cart_reservations back in the ledger.'''
+    if held:
+        await mongo.reservations_collection.bulk_write([
+            UpdateOne(
+                {"cart_id": cart_id, "product_id": product_id},
+                {
+                    "$inc": {"quantity": quantity},
+                    "$set": {"expires_at": _expires_at()}
+                },
+                upsert=True
+            )
+            for product_id, quantity in held.items()
+        ], ordered=False)
+
+
+async def release_carts(cart_ids: list, session=None):
+    '''Give back everything held by the given shopping carts.'''
+    held = await _claim_holds({"cart_id": {"$in": cart_ids}}, session=session)
+    await _release_counters(held, session=session)
+
+
+async def sweep_expired_reservations() -> int:
+    '''
+    Give back the holds whose time is up. The holds are claimed before
+    their units are released, so concurrent sweepers never release the
+    same hold twice. Returns how many units were released.
+    '''
+    held = await _claim_holds(
+        {"expires_at": {"$lte": datetime.now(timezone.utc)}}
+    )
+    await _release_counters(held)
+    return sum(held.values())
+
+
+async def reconcile_reserved_counters(
+        previous_drifts: dict[ObjectId, tuple[int, int]]) -> dict:
+    '''
+    Bring the reserved counters back in line with the ledger, which is
+    the record of what is held. A counter drifts when a worker dies
+    between writing the ledger and moving the counter. Writes in flight
+    are between those two steps too, so a product is only corrected once
+    two reconciliations in a row, given as previous_drifts, saw the same
+    counter with the same drift, and only while its counter didn't move.
+    Returns the drifts (product_id -> (reserved, drift)) left to confirm.
+    '''
+    ledger = mongo.reservations_collection.aggregate([
+        {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}}
+    ])
+    held = {
+        reservation['_id']: reservation['quantity']
+        async for reservation in ledger
+    }
+    products = mongo.products_collection.find(
+        {"$or": [
+            {"reserved": {"$gt": 0}},
+            {"_id": {"$in": list(held)}}
+        ]},
+        {"reserved": 1}
+    )
+
+    drifts = {}
+    corrections = []
+    async for product in products:
+        reserved = product.get('reserved', 0)
+        drift = reserved - held.get(product['_id'], 0)
+        if not drift:
+            continue
+        if previous_drifts.get(product['_id']) == (reserved, drift):
+            corrections.append(UpdateOne(
+                {"_id": product['_id'], "reserved": reserved},
+                {"$inc": {"reserved": -drift}}
+            ))
+        else:
+            drifts[product['_id']] = (reserved, drift)
+
+    if corrections:
+        await mongo.products_collection.bulk_write(corrections, ordered=False)
+        logger.warning(
+            'Corrected the reserved counters of %d products',
+            len(corrections)
+        )
+    return drifts
+
+
+async def run_reservation_sweeper(interval_seconds: float):
+    '''
+    Sweep the expired holds and reconcile the reserved counters every
+    interval_seconds, until cancelled.
+    '''
+    drifts = {}
+    while True:
+        try:
+            swept = await sweep_expired_reservations()
+            if swept:
+                logger.info('Released %d units of expired reservations', swept)
+            drifts = await reconcile_reserved_counters(drifts)
+        except Exception:
+            logger.exception('Stock reservation sweep failed')
+        await asyncio.sleep(interval_seconds)
+
+
+async def drop_product_reservations(product_ids: list, session=None):
+    '''Remove from the ledger every hold on the given deleted products.'''
+    await mongo.reservations_collection.delete_many(
+        {"product_id": {"$in": product_ids}},
+        session=session
+    )
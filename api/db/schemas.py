@@ -1,7 +1,7 @@
-from typing import List
-from pydantic import BaseModel
-from api.enums import ProductType
-from api.db.models import ProductInCart
+from typing import List, Optional
+from pydantic import BaseModel, model_validator
+from api.enums import BulkOperationType, JobStatus, ProductType
+from api.db.models import CartLine, Product
 
 
 class CreateOutput(BaseModel):
@@ -61,4 +61,116 @@ class GetShoppingCartOutput(BaseModel):
     '''Schema used as a response model in GET shopping_carts endpoints.'''
     id: str
     user_id: str
-    products: List[ProductInCart]
+    products: List[CartLine]
+    item_count: int
+    subtotal: float
+
+
+class ShoppingCartLineOutput(BaseModel):
+    '''Schema used as a response model for each line in
+    GET /api/shopping_carts/{shopping_cart_id}/view endpoint.
+    Products which don't exist anymore have no name nor unit price.
+    '''
+    product_id: str
+    name: Optional[str] = None
+    unit_price: Optional[float] = None
+    quantity: int
+    line_total: float
+    stock: int
+    exceeds_stock: bool
+
+
+class GetShoppingCartViewOutput(BaseModel):
+    '''Schema used as a response model in
+    GET /api/shopping_carts/{shopping_cart_id}/view endpoint.
+    '''
+    id: str
+    user_id: str
+    lines: List[ShoppingCartLineOutput]
+    item_count: int
+    subtotal: float
+    exceeds_stock: bool
+
+
+class BulkProductOperationInput(BaseModel):
+    '''Schema used as an input model for each operation in
+    POST /api/products/bulk endpoint.
+    '''
+    operation: BulkOperationType
+    id: Optional[str] = None
+    product: Optional[Product] = None
+
+    @model_validator(mode='after')
+    def check_operation_fields(self):
+        '''Ensure each operation brings the fields it needs.'''
+        if self.operation != BulkOperationType.CREATE and self.id is None:
+            raise ValueError(f"An id is required to {self.operation.value}")
+        if self.operation != BulkOperationType.DELETE and self.product is None:
+            raise ValueError(
+                f"A product is required to {self.operation.value}"
+            )
+        return self
+
+
+class BulkOperationOutput(BaseModel):
+    '''Schema used as a response model for each operation
+    in bulk endpoints.
+    '''
+    index: int
+    id: Optional[str] = None
+    status_code: int
+    detail: Optional[str] = None
+
+
+class ImportUsersOutput(BaseModel):
+    '''Schema used as a response model for the user import endpoint.'''
+    import_id: str
+    processed: int
+    imported: int
+    failed: int
+    errors: List[BulkOperationOutput]
+    elapsed_seconds: float
+    users_per_second: float
+
+
+class CreateJobOutput(BaseModel):
+    '''Schema used as a response model in endpoints
+    which start a background job.
+    '''
+    job_id: str
+
+
+class GetJobOutput(BaseModel):
+    '''Schema used as a response model in GET /api/jobs/{job_id} endpoint.'''
+    id: str
+    kind: str
+    target_id: str
+    status: JobStatus
+    error: Optional[str] = None
+
+
+class ThemeFacetOutput(BaseModel):
+    '''Schema used as a response model for each theme facet
+    in GET /api/products/search endpoint.
+    '''
+    theme: ProductType
+    count: int
+
+
+class PriceFacetOutput(BaseModel):
+    '''Schema used as a response model for each price facet
+    in GET /api/products/search endpoint. The last bucket has no max_price.
+    '''
+    min_price: float
+    max_price: Optional[float] = None
+    count: int
+
+
+class SearchProductsOutput(BaseModel):
+    '''Schema used as a response model in
+    GET /api/products/search endpoint.
+    '''
+    total: int
+    products: List[GetProductOutput]
+    theme_facets: List[ThemeFacetOutput]
+    price_facets: List[PriceFacetOutput]
@@ -1,20 +1,187 @@
+from typing import Optional
+from urllib.parse import quote_plus
 import motor.motor_asyncio
-from api.constants import (
-    MONGO_DB_USER,
-    MONGO_DB_PASSWORD,
-    MONGO_DB_CLUSTER_URL,
-    MONGO_DB_APP_NAME
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from pymongo import monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import (
+    make_read_preference,
+    read_pref_mode_from_name
 )
+from api.constants import METRICS_ENABLED
+from api.metrics import CommandMetricsListener
 
-mongo_db_url = "mongodb+srv://"
-mongo_db_url += MONGO_DB_USER + ":"
-mongo_db_url += MONGO_DB_PASSWORD + "@"
-mongo_db_url += MONGO_DB_CLUSTER_URL + "/?retryWrites=true&w=majority&appName="
-mongo_db_url += MONGO_DB_APP_NAME
 
-client = motor.motor_asyncio.AsyncIOMotorClient(mongo_db_url)
+class MongoSettings(BaseSettings):
+    '''
+    MongoDB connection settings. Each attribute is read from the
+    environment variable with its name in upper case, prefixed by
+    MONGO_DB_ (e.g. MONGO_DB_MAX_POOL_SIZE).
+    '''
+    model_config = SettingsConfigDict(env_prefix='MONGO_DB_')
 
-db = client.ecommerce_db
-users_collection = db["users_data"]
-products_collection = db["products_data"]
-shopping_carts_collection = db["shopping_carts_data"]
+    url: Optional[str] = None
+    user: Optional[str] = None
+    password: Optional[str] = None
+    cluster_url: Optional[str] = None
+    app_name: Optional[str] = None
+    name: str = 'ecommerce_db'
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    wait_queue_timeout_ms: Optional[int] = None
+    server_selection_timeout_ms: int = 30000
+    compressors: Optional[str] = None
+    catalog_read_preference: str = 'primary'
+    catalog_max_staleness_seconds: int = -1
+    catalog_read_concern: Optional[str] = None
+
+    def connection_url(self) -> str:
+        '''
+        The plain mongodb:// URL given in MONGO_DB_URL or, if there is
+        none, the Atlas mongodb+srv:// URL built from the cluster settings.
+        '''
+        if self.url:
+            return self.url
+
+        mongo_db_url = "mongodb+srv://"
+        mongo_db_url += quote_plus(self.user) + ":"
+        mongo_db_url += quote_plus(self.password) + "@"
+        mongo_db_url += self.cluster_url
+        mongo_db_url += "/?retryWrites=true&w=majority&appName="
+        mongo_db_url += self.app_name
+        return mongo_db_url
+
+    def client_options(self) -> dict:
+        '''Keyword arguments given to the MongoDB client.'''
+        options = {
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms
+        }
+        if self.wait_queue_timeout_ms is not None:
+            options['waitQueueTimeoutMS'] = self.wait_queue_timeout_ms
+        if self.compressors:
+            options['compressors'] = self.compressors
+        return options
+
+    def catalog_read_options(self) -> dict:
+        '''
+        Read preference and read concern of the catalog reads, e.g.
+        secondaryPreferred or nearest, optionally bounded by
+        maxStalenessSeconds (-1 means no bound, otherwise at least 90).
+        '''
+        return {
+            'read_preference': make_read_preference(
+                read_pref_mode_from_name(self.catalog_read_preference),
+                None,
+                self.catalog_max_staleness_seconds
+            ),
+            'read_concern': ReadConcern(self.catalog_read_concern)
+        }
+
+
+class MongoConnection:
+    '''
+    MongoDB client and collections used by the API. The client is only
+    created by connect(), which the app lifespan calls on startup, or on
+    first use, so the package can be imported without a database.
+    '''
+
+    def __init__(
+            self,
+            settings: MongoSettings,
+            event_listeners: list[monitoring.CommandListener] = None):
+        self.settings = settings
+        self.event_listeners = event_listeners or []
+        self._client = None
+
+    def connect(self, client=None):
+        '''
+        Create the client, if it wasn't created yet. A client created
+        elsewhere, e.g. an in-memory stand-in, can be given instead.
+        '''
+        if client is not None:
+            self._client = client
+        elif self._client is None:
+            self._client = motor.motor_asyncio.AsyncIOMotorClient(
+                self.settings.connection_url(),
+                event_listeners=self.event_listeners,
+                **self.settings.client_options()
+            )
+
+    def close(self):
+        '''Close the client and its connection pool.'''
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    @property
+    def client(self) -> motor.motor_asyncio.AsyncIOMotorClient:
+        self.connect()
+        return self._client
+
+    @property
+    def db(self) -> motor.motor_asyncio.AsyncIOMotorDatabase:
+        return self.client[self.settings.name]
+
+    def catalog_collection(
+            self,
+            name: str) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        '''
+        Handle for the catalog reads of a collection, which may be served
+        by secondaries. Everything else, including cart and stock reads,
+        uses the plain handles, which always read from the primary.
+        '''
+        return self.db.get_collection(
+            name,
+            **self.settings.catalog_read_options()
+        )
+
+    @property
+    def users_collection(self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["users_data"]
+
+    @property
+    def products_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["products_data"]
+
+    @property
+    def shopping_carts_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["shopping_carts_data"]
+
+    @property
+    def jobs_collection(self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["jobs_data"]
+
+    @property
+    def reservations_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["reservations_data"]
+
+    @property
+    def idempotency_keys_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["idempotency_keys_data"]
+
+    @property
+    def user_imports_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.db["user_imports_data"]
+
+    @property
+    def catalog_users_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.catalog_collection("users_data")
+
+    @property
+    def catalog_products_collection(
+            self) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        return self.catalog_collection("products_data")
+
+
+mongo = MongoConnection(
+    MongoSettings(),
+    [CommandMetricsListener()] if METRICS_ENABLED else []
+)
@@ -20,3 +20,17 @@ class SortableProductFields(str, Enum):
     THEME = 'theme'
     PRICE = 'price'
     QUANTITY = 'quantity'
+
+
+class BulkOperationType(str, Enum):
+    '''Used to enumerate all operations accepted by bulk endpoints.'''
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+
+class JobStatus(str, Enum):
+    '''Used to enumerate all possible statuses of a background job.'''
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Awaitable, Callable
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from starlette.responses import JSONResponse
+from api.constants import (
+    IDEMPOTENCY_CACHE_MAX_SIZE,
+    IDEMPOTENCY_LOCK_SECONDS,
+    IDEMPOTENCY_MAX_BODY_BYTES,
+    IDEMPOTENCY_TTL_SECONDS
+)
+from api.db.settings import mongo
+
+IDEMPOTENCY_KEY_HEADER = b'idempotency-key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+REPLAYED_HEADER = (b'idempotent-replayed', b'true')
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+# Endpoints streaming bodies which can be far larger than memory. Making
+# them idempotent would buffer and store whole bodies and responses, so
+# they run as if no key was sent. Imports resume by import_id instead.
+STREAMING_PATHS = {'/api/products/bulk', '/api/users/import'}
+
+# Status of a key in the idempotency_keys collection.
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class IdempotencyKeyMismatch(Exception):
+    '''Raised when a key is reused for a different request.'''
+
+
+class StoredResponse:
+    '''Status, headers and body of a response to an idempotent request.'''
+
+    def __init__(self, status: int, headers: list, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'StoredResponse':
+        return cls(
+            doc['status'],
+            [
+                (name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in doc['headers']
+            ],
+            bytes(doc['body'])
+        )
+
+    def to_doc(self) -> dict:
+        return {
+            'status': self.status,
+            'headers': [
+                [name.decode('latin-1'), value.decode('latin-1')]
+                for name, value in self.headers
+            ],
+            'body': self.body
+        }
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class IdempotencyStore:
+    '''
+    Runs each idempotent request once per key and keeps its response, so
+    retries get the same response back. Responses are stored in the
+    idempotency_keys collection until IDEMPOTENCY_TTL_SECONDS go by, and
+    the latest ones are also kept in process, so a replay usually doesn't
+    reach the database at all. Duplicates arriving while the request is
+    still running wait for its response instead of running it again:
+    in process they share the same execution, and across workers they
+    poll the stored key until the worker holding it is done. The worker
+    running a request keeps renewing its lock on the key, so requests
+    running longer than IDEMPOTENCY_LOCK_SECONDS keep it too, while a
+    worker that dies loses the key once its lock runs out.
+    '''
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._responses = OrderedDict()
+        self._executions = {}
+
+    async def run(
+            self,
+            key: str,
+            fingerprint: str,
+            execute: Callable[[], Awaitable[StoredResponse]]):
+        '''
+        Response of the request identified by key, running execute only
+        if no response is stored for it yet. The fingerprint identifies
+        the request the key was first used with.
+        Returns a tuple with the response and whether it was replayed.
+        '''
+        entry = self._responses.get(key)
+        if entry is not None and entry[0] > monotonic():
+            self._responses.move_to_end(key)
+            if entry[1] != fingerprint:
+                raise IdempotencyKeyMismatch(key)
+            return entry[2], True
+
+        execution = self._executions.get(key)
+        if execution is not None:
+            if execution[0] != fingerprint:
+                raise IdempotencyKeyMismatch(key)
+            response, _ = await asyncio.shield(execution[1])
+            return response, True
+
+        task = asyncio.ensure_future(self._run_once(key, fingerprint, execute))
+        self._executions[key] = (fingerprint, task)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._executions.get(key, (None, None))[1] is task:
+                del self._executions[key]
+
+    async def _run_once(
+            self,
+            key: str,
+            fingerprint: str,
+            execute: Callable[[], Awaitable[StoredResponse]]):
+        collection = mongo.idempotency_keys_collection
+        lock_id = ObjectId()
+        wait = 0.01
+        while True:
+            doc = await collection.find_one({"_id": key})
+            if doc is None:
+                try:
+                    await collection.insert_one({
+                        "_id": key,
+                        "fingerprint": fingerprint,
+                        "status": IN_PROGRESS,
+                        "lock_id": lock_id,
+                        "locked_until": self._lock_expiry(),
+                        "expires_at": self._expiry()
+                    })
+                    break
+                except DuplicateKeyError:
+                    continue
+
+            if doc['fingerprint'] != fingerprint:
+                raise IdempotencyKeyMismatch(key)
+            if doc['status'] == COMPLETED:
+                response = StoredResponse.from_doc(doc['response'])
+                self._remember(key, fingerprint, response)
+                return response, True
+
+            if doc['locked_until'].replace(tzinfo=timezone.utc) < _now():
+                taken = await collection.find_one_and_update(
+                    {
+                        "_id": key,
+                        "status": IN_PROGRESS,
+                        "locked_until": doc['locked_until']
+                    },
+                    {"$set": {
+                        "lock_id": lock_id,
+                        "locked_until": self._lock_expiry()
+                    }}
+                )
+                if taken is not None:
+                    break
+
+            await asyncio.sleep(wait)
+            wait = min(wait * 2, 0.5)
+
+        lock_renewal = asyncio.ensure_future(self._renew_lock(key, lock_id))
+        try:
+            response = await execute()
+        except BaseException:
+            lock_renewal.cancel()
+            await collection.delete_one({"_id": key})
+            raise
+        lock_renewal.cancel()
+
+        # Server errors aren't kept, so the request can be retried.
+        if response.status >= 500:
+            await collection.delete_one({"_id": key})
+            return response, False
+
+        await collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "status": COMPLETED,
+                "response": response.to_doc(),
+                "expires_at": self._expiry()
+            }}
+        )
+        self._remember(key, fingerprint, response)
+        return response, False
+
+    async def _renew_lock(self, key: str, lock_id: ObjectId):
+        '''
+        Push the lock on a key forward while its request runs, a few
+        times per IDEMPOTENCY_LOCK_SECONDS, as long as this run holds it.
+        '''
+        collection = mongo.idempotency_keys_collection
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LOCK_SECONDS / 3)
+            try:
+                await collection.update_one(
+                    {"_id": key, "status": IN_PROGRESS, "lock_id": lock_id},
+                    {"$set": {"locked_until": self._lock_expiry()}}
+                )
+            except PyMongoError:
+                # Try again on the next beat, while the lock still holds.
+                continue
+
+    def _remember(self, key: str, fingerprint: str, response):
+        expires_at = monotonic() + IDEMPOTENCY_TTL_SECONDS
+        self._responses[key] = (expires_at, fingerprint, response)
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.max_size:
+            self._responses.popitem(last=False)
+
+    @staticmethod
+    def _expiry() -> datetime:
+        return _now() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+
+    @staticmethod
+    def _lock_expiry() -> datetime:
+        return _now() + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_MAX_SIZE)
+
+
+class IdempotencyMiddleware:
+    '''
+    ASGI middleware making the write requests sent with an
+    Idempotency-Key header safe to retry: the first request with a key
+    runs, and every later request with the same key gets its response
+    back, marked with an Idempotent-Replayed header, without running
+    again. Reusing a key for a different method, path, query or body is
+    refused with 422. Request bodies are buffered to be fingerprinted, so
+    bodies over IDEMPOTENCY_MAX_BODY_BYTES are refused with 413.
+    Requests without the header, and the requests to STREAMING_PATHS,
+    are left untouched.
+    '''
+
+    def __init__(self, app, store: IdempotencyStore = idempotency_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http'
+                or scope['method'] not in WRITE_METHODS
+                or scope['path'] in STREAMING_PATHS):
+            return await self.app(scope, receive, send)
+
+        key = dict(scope['headers']).get(IDEMPOTENCY_KEY_HEADER)
+        if key is None:
+            return await self.app(scope, receive, send)
+
+        key = key.decode('latin-1')
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            response = JSONResponse(
+                {"detail": "Idempotency key not valid"},
+                status_code=422
+            )
+            return await response(scope, receive, send)
+
+        body = await self._read_body(receive)
+        if body is None:
+            response = JSONResponse(
+                {"detail": "Request body too large for an idempotency key"},
+                status_code=413
+            )
+            return await response(scope, receive, send)
+
+        fingerprint = hashlib.sha256(b'\n'.join([
+            scope['method'].encode(),
+            scope['path'].encode(),
+            scope['query_string'],
+            body
+        ])).hexdigest()
+
+        try:
+            response, replayed = await self.store.run(
+                key,
+                fingerprint,
+                lambda: self._execute(scope, body)
+            )
+        except IdempotencyKeyMismatch:
+            response = JSONResponse(
+                {"detail": "Idempotency key used for another request"},
+                status_code=422
+            )
+            return await response(scope, receive, send)
+
+        headers = list(response.headers)
+        if replayed:
+            headers.append(REPLAYED_HEADER)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': headers
+        })
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        '''
+        Read the whole request body. Returns None as soon as it grows over
+        IDEMPOTENCY_MAX_BODY_BYTES.
+        '''
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > IDEMPOTENCY_MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    async def _execute(self, scope, body: bytes) -> StoredResponse:
+        '''Run the request and collect its whole response.'''
+        body_sent = False
+        status = 500
+        headers = []
+        chunks = []
+
+        async def receive():
+            nonlocal body_sent
+            if body_sent:
+                return {'type': 'http.disconnect'}
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            nonlocal status, headers
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                headers = list(message.get('headers', []))
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return StoredResponse(status, headers, b''.join(chunks))
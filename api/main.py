@@ -1,12 +1,82 @@
+import asyncio
+import logging
 import sys
+from contextlib import asynccontextmanager
 
 sys.path.append('..')
 
 from fastapi import FastAPI
-from api.routers import products, shopping_carts, users
+from api.constants import (
+    CHANGE_STREAM_NAME,
+    CHANGE_STREAMS_ENABLED,
+    ENSURE_INDEXES_ON_STARTUP,
+    IDEMPOTENCY_ENABLED,
+    INDEX_REPORT_ON_STARTUP,
+    METRICS_ENABLED,
+    RESERVATION_SWEEP_INTERVAL_SECONDS
+)
+from api.db.cache import products_cache
+from api.db.change_streams import (
+    MongoResumeTokenStore,
+    watch_cache_invalidations
+)
+from api.db.indexes import ensure_indexes, format_index_report, index_report
+from api.db.reservations import run_reservation_sweeper
+from api.db.settings import mongo
+from api.idempotency import IdempotencyMiddleware
+from api.metrics import MetricsMiddleware
+from api.routers import jobs, metrics, products, shopping_carts, users
 
+logger = logging.getLogger('uvicorn.error')
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''
+    Connect to the database and prepare it before the API starts serving
+    requests, run the background tasks while it is up and close the
+    connection pool on shutdown.
+    '''
+    mongo.connect()
+    if ENSURE_INDEXES_ON_STARTUP:
+        await ensure_indexes(mongo.db)
+    if INDEX_REPORT_ON_STARTUP:
+        report = await index_report(mongo.db)
+        logger.info('MongoDB index report:\n%s', format_index_report(report))
+
+    background_tasks = []
+    if CHANGE_STREAMS_ENABLED:
+        background_tasks.append(asyncio.create_task(
+            watch_cache_invalidations(
+                mongo.db,
+                {'products_data': products_cache},
+                MongoResumeTokenStore(
+                    mongo.db['change_stream_tokens'],
+                    CHANGE_STREAM_NAME
+                )
+            )
+        ))
+    if RESERVATION_SWEEP_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(
+            run_reservation_sweeper(RESERVATION_SWEEP_INTERVAL_SECONDS)
+        ))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    mongo.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(products.router)
 app.include_router(users.router)
 app.include_router(shopping_carts.router)
+app.include_router(jobs.router)
+
+if IDEMPOTENCY_ENABLED:
+    app.add_middleware(IdempotencyMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics.router)
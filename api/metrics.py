@@ -0,0 +1,270 @@
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+from pymongo import monitoring
+from api.db.cache import products_cache
+
+PROMETHEUS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+# Metrics are updated from the event loop and, for the command listener,
+# from the threads Motor runs the driver on.
+_lock = threading.Lock()
+
+
+def _format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for name, value in zip(label_names, label_values)
+    )
+    return '{' + labels + '}'
+
+
+class Counter:
+    '''Prometheus counter with labels.'''
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with _lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount
+            )
+
+    def samples(self):
+        with _lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, label_values, value
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        for name, label_values, value in self.samples():
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines)
+
+
+class Gauge(Counter):
+    '''Prometheus gauge with labels.'''
+    type = 'gauge'
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Counter):
+    '''Prometheus histogram with labels and fixed buckets.'''
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            label_names: tuple = (),
+            buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+
+    def observe(self, *label_values, value: float):
+        with _lock:
+            counts = self._values.setdefault(
+                label_values,
+                [0] * (len(self.buckets) + 1) + [0.0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        with _lock:
+            values = [
+                (label_values, list(counts))
+                for label_values, counts in self._values.items()
+            ]
+        label_names = self.label_names + ('le',)
+        for label_values, counts in values:
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                labels = _format_labels(label_names, label_values + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_count{labels} {counts[-2]}')
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+        return '\n'.join(lines)
+
+
+http_requests_in_flight = Gauge(
+    'http_requests_in_flight',
+    'HTTP requests being served.'
+)
+http_request_duration_seconds = Histogram(
+    'http_request_duration_seconds',
+    'Latency of the HTTP requests, per route.',
+    ('method', 'route', 'status')
+)
+mongo_commands_per_request = Histogram(
+    'mongo_commands_per_request',
+    'MongoDB commands sent while serving an HTTP request, per route.',
+    ('method', 'route'),
+    COUNT_BUCKETS
+)
+mongo_duration_per_request_seconds = Histogram(
+    'mongo_duration_per_request_seconds',
+    'Time spent in MongoDB commands while serving an HTTP request, '
+    'per route.',
+    ('method', 'route')
+)
+mongo_command_duration_seconds = Histogram(
+    'mongo_command_duration_seconds',
+    'Latency of the MongoDB commands, per command.',
+    ('command', 'status')
+)
+
+METRICS = [
+    http_requests_in_flight,
+    http_request_duration_seconds,
+    mongo_commands_per_request,
+    mongo_duration_per_request_seconds,
+    mongo_command_duration_seconds
+]
+
+
+class RequestStats:
+    '''MongoDB commands sent while serving one HTTP request.'''
+
+    def __init__(self):
+        self.commands = 0
+        self.duration = 0.0
+
+
+_request_stats: ContextVar[RequestStats] = ContextVar('request_stats')
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    '''
+    Driver command listener recording the latency of every MongoDB
+    command, and adding it to the stats of the HTTP request that sent it.
+    Motor runs the driver with a copy of the caller's context, so the
+    request stats set by MetricsMiddleware are visible here.
+    '''
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event, 'succeeded')
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._record(event, 'failed')
+
+    def _record(self, event, status: str):
+        duration = event.duration_micros / 1e6
+        mongo_command_duration_seconds.observe(
+            event.command_name,
+            status,
+            value=duration
+        )
+        stats = _request_stats.get(None)
+        if stats is not None:
+            with _lock:
+                stats.commands += 1
+                stats.duration += duration
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording the in-flight HTTP requests and, per route,
+    their latency and the MongoDB commands they sent. Requests matching
+    no route are recorded under the "unmatched" route.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        response_status = 500
+
+        async def send_with_status(message):
+            nonlocal response_status
+            if message['type'] == 'http.response.start':
+                response_status = message['status']
+            await send(message)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        http_requests_in_flight.inc()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = perf_counter() - start
+            http_requests_in_flight.dec()
+            _request_stats.reset(token)
+
+            route = scope.get('route')
+            route = getattr(route, 'path', 'unmatched')
+            method = scope['method']
+            http_request_duration_seconds.observe(
+                method,
+                route,
+                response_status,
+                value=duration
+            )
+            mongo_commands_per_request.observe(
+                method,
+                route,
+                value=stats.commands
+            )
+            mongo_duration_per_request_seconds.observe(
+                method,
+                route,
+                value=stats.duration
+            )
+
+
+def _cache_metrics() -> list:
+    stats = products_cache.stats()
+    return [
+        '# HELP product_cache_hits_total Product cache hits.',
+        '# TYPE product_cache_hits_total counter',
+        f'product_cache_hits_total {stats["hits"]}',
+        '# HELP product_cache_misses_total Product cache misses.',
+        '# TYPE product_cache_misses_total counter',
+        f'product_cache_misses_total {stats["misses"]}',
+        '# HELP product_cache_size Products held by the product cache.',
+        '# TYPE product_cache_size gauge',
+        f'product_cache_size {stats["size"]}'
+    ]
+
+
+def render_metrics() -> str:
+    '''All metrics in the Prometheus text exposition format.'''
+    lines = [metric.render() for metric in METRICS] + _cache_metrics()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from api.constants import (
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_SCRYPT_N,
+    PASSWORD_SCRYPT_P,
+    PASSWORD_SCRYPT_R
+)
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=256 * n * r * p,
+        dklen=KEY_SIZE
+    )
+
+
+def hash_password_sync(
+        password: str,
+        n: int = PASSWORD_SCRYPT_N,
+        r: int = PASSWORD_SCRYPT_R,
+        p: int = PASSWORD_SCRYPT_P) -> str:
+    '''
+    Hash a password with scrypt and a random salt. The cost parameters
+    are stored along with the hash, as scrypt$n$r$p$salt$key, so they can
+    be raised without invalidating the existing hashes. CPU heavy by
+    design: call hash_password from the event loop instead.
+    '''
+    salt = os.urandom(SALT_SIZE)
+    key = _scrypt(password, salt, n, r, p)
+    return '$'.join([
+        'scrypt',
+        str(n),
+        str(r),
+        str(p),
+        b64encode(salt).decode(),
+        b64encode(key).decode()
+    ])
+
+
+def verify_password_sync(password: str, password_hash: str) -> bool:
+    '''Check a password against a hash made by hash_password_sync.'''
+    try:
+        algorithm, n, r, p, salt, key = password_hash.split('$')
+    except ValueError:
+        return False
+    if algorithm != 'scrypt':
+        return False
+
+    expected_key = b64decode(key)
+    actual_key = _scrypt(password, b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(actual_key, expected_key)
+
+
+class PasswordHasher:
+    '''
+    Runs password hashing and verification on a bounded thread pool, so
+    the event loop keeps serving other requests meanwhile. hashlib
+    releases the GIL while running scrypt, so up to max_workers hashes
+    run in parallel; further ones wait in the pool queue.
+    '''
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='password-hasher'
+        )
+
+    async def hash(self, password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            hash_password_sync,
+            password
+        )
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            verify_password_sync,
+            password,
+            password_hash
+        )
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS)
@@ -0,0 +1,59 @@
+import hashlib
+from fastapi import Request, Response
+
+ETAG_HEADER = 'ETag'
+CACHE_CONTROL_HEADER = 'Cache-Control'
+
+
+def document_etag(obj: dict) -> str:
+    '''
+    Weak ETag of a single document, taken from its id and its version,
+    which is bumped by every write changing the document.
+    '''
+    return f'W/"{obj["_id"]}-{obj.get("version", 0)}"'
+
+
+def page_etag(request: Request, versions: list) -> str:
+    '''
+    Weak ETag of a page of documents, hashed from the query parameters
+    of the request and the (id, version) pair of every document in the
+    page, so it changes whenever a document enters, leaves or changes in
+    the page.
+    '''
+    digest = hashlib.sha1(
+        repr(sorted(request.query_params.multi_items())).encode()
+    )
+    for id, version in versions:
+        digest.update(f'{id}-{version or 0};'.encode())
+    return f'W/"{digest.hexdigest()}"'
+
+
+def cache_headers(etag: str, cache_control: str) -> dict:
+    '''Caching headers of a response. An empty Cache-Control is left out.'''
+    headers = {ETAG_HEADER: etag}
+    if cache_control:
+        headers[CACHE_CONTROL_HEADER] = cache_control
+    return headers
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    '''
+    Whether the If-None-Match header of the request matches the ETag,
+    using the weak comparison, so the client's copy is still current.
+    '''
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    etag = etag.removeprefix('W/')
+    return any(
+        tag.strip().removeprefix('W/') == etag
+        for tag in if_none_match.split(',')
+    )
+
+
+def not_modified_response(headers: dict) -> Response:
+    '''Empty 304 response, sent instead of serializing the body again.'''
+    return Response(status_code=304, headers=headers)
@@ -0,0 +1,49 @@
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+def output_projection(fields: list) -> dict:
+    '''
+    Aggregation projection shaping documents exactly as the GET endpoints
+    return them, with the _id converted to a string id.
+    '''
+    projection = {'_id': 0, 'id': {'$toString': '$_id'}}
+    projection.update({field: 1 for field in fields})
+    return projection
+
+
+async def find_output_page(
+        collection: AsyncIOMotorCollection,
+        query_filter: dict,
+        sort: list,
+        skip: int,
+        limit: int,
+        projection: dict) -> list:
+    '''
+    Find a page of objects already shaped by the database as the
+    response, so they can be serialized without further processing.
+    '''
+    pipeline = [
+        {'$match': query_filter},
+        {'$sort': dict(sort)},
+        {'$skip': skip}
+    ]
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.append({'$project': projection})
+
+    return await collection.aggregate(pipeline).to_list(length=None)
+
+
+def output_as_document(output: dict) -> dict:
+    '''Restore the _id of an object shaped by output_projection.'''
+    return {'_id': ObjectId(output['id']), **output}
+
+
+def fast_json_response(content, headers: dict = None) -> ORJSONResponse:
+    '''
+    Serialize content once with orjson, skipping the validation and
+    serialization FastAPI would otherwise redo through the response model.
+    '''
+    return ORJSONResponse(content, headers=headers)
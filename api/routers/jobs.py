@@ -0,0 +1,26 @@
+from bson import ObjectId
+from fastapi import APIRouter, HTTPException, status
+from api.db.actions import find_obj_by_id
+from api.db.settings import mongo
+from api.db.schemas import GetJobOutput
+
+router = APIRouter()
+
+
+@router.get("/api/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def find_job_by_id(job_id: str) -> GetJobOutput:
+    '''Endpoint used to retrieve the status of a background job.'''
+    try:
+        id = ObjectId(job_id)
+        job = await find_obj_by_id(mongo.jobs_collection, id)
+        response = {
+            'id': str(job['_id']),
+            'kind': job['kind'],
+            'target_id': str(job['target_id']),
+            'status': job['status'],
+            'error': job.get('error')
+        }
+    except Exception:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return response
@@ -0,0 +1,18 @@
+from fastapi import APIRouter, status
+from fastapi.responses import Response
+from api.metrics import PROMETHEUS_MEDIA_TYPE, render_metrics
+
+router = APIRouter()
+
+
+@router.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+    include_in_schema=False
+)
+async def get_metrics() -> Response:
+    '''
+    Endpoint used by Prometheus to scrape the request latency, MongoDB
+    command and product cache metrics of this process.
+    '''
+    return Response(render_metrics(), media_type=PROMETHEUS_MEDIA_TYPE)
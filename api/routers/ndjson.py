@@ -0,0 +1,100 @@
+import csv
+from typing import AsyncIterator, Callable
+import orjson
+from fastapi import HTTPException, Request
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+CSV_MEDIA_TYPE = 'text/csv'
+
+# Yielded by iter_request_items in place of a line that isn't valid JSON.
+INVALID_JSON = object()
+
+
+async def stream_ndjson(
+        objs: AsyncIterator[dict],
+        to_output: Callable[[dict], dict],
+        batch_size: int) -> AsyncIterator[bytes]:
+    '''
+    Serialize objects as newline delimited JSON, yielding one chunk per
+    batch_size objects, so memory stays constant whatever the number of
+    objects is.
+    '''
+    lines = []
+    async for obj in objs:
+        lines.append(orjson.dumps(to_output(obj)))
+        if len(lines) >= batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+def _decode_line(line: bytes):
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return INVALID_JSON
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    '''Yield the non-blank lines of a stream of byte chunks.'''
+    buffer = b''
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def iter_ndjson_items(chunks: AsyncIterator[bytes]) -> AsyncIterator:
+    '''
+    Yield the JSON values of a stream of NDJSON chunks, or INVALID_JSON
+    in place of the lines that aren't valid JSON.
+    '''
+    async for line in iter_lines(chunks):
+        yield _decode_line(line)
+
+
+async def iter_csv_items(chunks: AsyncIterator[bytes]) -> AsyncIterator:
+    '''
+    Yield the rows of a stream of CSV chunks as dicts keyed by the names
+    in the header row. Quoted values can't span lines.
+    '''
+    header = None
+    async for line in iter_lines(chunks):
+        row = next(csv.reader([line.decode('utf-8-sig').rstrip('\r')]))
+        if header is None:
+            header = row
+        else:
+            yield dict(zip(header, row))
+
+
+async def iter_request_items(request: Request) -> AsyncIterator:
+    '''
+    Yield the items of a request body, which is either a JSON array or,
+    when sent as application/x-ndjson, one JSON value per line. NDJSON
+    bodies are decoded while they are received, so they don't need to
+    fit in memory.
+    '''
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith(NDJSON_MEDIA_TYPE):
+        async for item in iter_ndjson_items(request.stream()):
+            yield item
+        return
+
+    try:
+        items = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        items = None
+    if not isinstance(items, list):
+        raise HTTPException(
+            status_code=422,
+            detail="The body must be a JSON array or NDJSON."
+        )
+
+    for item in items:
+        yield item
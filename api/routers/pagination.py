@@ -0,0 +1,70 @@
+import base64
+import json
+from bson import ObjectId
+from fastapi import HTTPException
+from api.enums import SortableProductFields
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def sort_key(field: SortableProductFields) -> str:
+    '''Document key used when sorting by the given product attribute.'''
+    if field == SortableProductFields.ID:
+        return '_id'
+    return field.value
+
+
+def sort_spec(key: str, descending: bool) -> list:
+    '''
+    Sort specification for the given key. The _id is always used as a
+    tiebreaker, so the order is total and can be resumed by a cursor.
+    '''
+    direction = -1 if descending else 1
+    if key == '_id':
+        return [('_id', direction)]
+    return [(key, direction), ('_id', direction)]
+
+
+def encode_cursor(key: str, descending: bool, last_obj: dict) -> str:
+    '''Build an opaque cursor pointing right after the given object.'''
+    payload = {
+        'key': key,
+        'descending': descending,
+        'id': str(last_obj['_id'])
+    }
+    if key != '_id':
+        payload['value'] = last_obj.get(key)
+
+    raw_payload = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw_payload).decode().rstrip('=')
+
+
+def keyset_filter(cursor: str, key: str, descending: bool) -> dict:
+    '''
+    Filter matching all objects after the one encoded in the cursor,
+    according to the given sort. A cursor can only be used with the same
+    sort it was issued for.
+    '''
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        last_id = ObjectId(payload['id'])
+        is_valid = (
+            payload['key'] == key
+            and payload['descending'] == descending
+        )
+    except Exception:
+        is_valid = False
+
+    if not is_valid:
+        raise HTTPException(status_code=422, detail="Cursor not valid")
+
+    operator = '$lt' if descending else '$gt'
+    if key == '_id':
+        return {'_id': {operator: last_id}}
+
+    last_value = payload.get('value')
+    return {'$or': [
+        {key: {operator: last_value}},
+        {key: last_value, '_id': {operator: last_id}}
+    ]}
@@ -1,43 +1,384 @@
-from typing import List
+from typing import List, Optional
 from bson import ObjectId
-from fastapi import APIRouter, Depends, HTTPException, status
-from api.constants import MAX_PAGE_SIZE
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Request,
+    Response,
+    status
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from api.constants import (
+    BULK_WRITE_CHUNK_SIZE,
+    EXPORT_BATCH_SIZE,
+    FAST_JSON_RESPONSES,
+    MAX_PAGE_SIZE,
+    PRODUCT_CACHE_CONTROL,
+    PRODUCT_LIST_CACHE_CONTROL
+)
 from api.db.actions import (
+    DUPLICATE_KEY_ERROR,
+    ID_PROJECTION,
     create_obj,
-    delete_obj,
     find_obj_by_id,
+    find_objs_by_ids,
     update_obj
 )
+from api.db.cache import (
+    PRODUCT_CACHE_PROJECTION,
+    find_cached_obj_by_id,
+    products_cache
+)
+from api.db.cart_actions import (
+    remove_products_from_carts,
+    update_cart_prices
+)
+from api.db.cascades import delete_product_cascade, run_cascade
+from api.db.jobs import start_job
 from api.db.models import Product
-from api.db.settings import products_collection, shopping_carts_collection
+from api.db.reservations import drop_product_reservations
+from api.db.settings import mongo
 from api.db.schemas import (
+    BulkOperationOutput,
+    BulkProductOperationInput,
+    CreateJobOutput,
     CreateOutput,
     GetProductOutput,
+    SearchProductsOutput,
     UpdateOutput,
     UpdateProductStockInput
 )
-from api.routers.query_params import QueryParams
+from api.routers.fast_json import (
+    fast_json_response,
+    find_output_page,
+    output_as_document,
+    output_projection
+)
+from api.enums import BulkOperationType
+from api.routers.etags import (
+    ETAG_HEADER,
+    cache_headers,
+    document_etag,
+    is_not_modified,
+    not_modified_response,
+    page_etag
+)
+from api.routers.ndjson import (
+    INVALID_JSON,
+    NDJSON_MEDIA_TYPE,
+    iter_request_items,
+    stream_ndjson
+)
+from api.routers.pagination import (
+    NEXT_CURSOR_HEADER,
+    encode_cursor,
+    keyset_filter,
+    sort_key,
+    sort_spec
+)
+from api.routers.query_params import QueryParams, SearchParams
 
 router = APIRouter()
 
+PRODUCT_PROJECTION = {'name': 1, 'theme': 1, 'price': 1, 'quantity': 1}
+PRODUCT_OUTPUT_PROJECTION = output_projection(list(PRODUCT_PROJECTION))
+# Projections of the listing, which also needs the versions for its ETag.
+PRODUCT_VERSION_PROJECTION = {**PRODUCT_PROJECTION, 'version': 1}
+PRODUCT_VERSION_OUTPUT_PROJECTION = output_projection(
+    list(PRODUCT_VERSION_PROJECTION)
+)
+# Every write changing a product bumps its version, which its ETag uses.
+PRODUCT_VERSION_INCREMENT = {'version': 1}
+PRODUCT_PRICE_PROJECTION = {'price': 1}
+PRICE_FACET_BOUNDARIES = [0, 10, 25, 50, 100, 250, 500, 1000]
+
+
+def product_output(product: dict) -> dict:
+    '''Shape a product document as returned by the GET endpoints.'''
+    return {
+        'id': str(product['_id']),
+        'name': product['name'],
+        'theme': product['theme'],
+        'price': product['price'],
+        'quantity': product['quantity']
+    }
+
+
+def products_query(params: QueryParams) -> tuple[dict, str, bool]:
+    '''
+    Translate the filtering and sorting settings into a query filter,
+    a sort key and a sort direction.
+    '''
+    query_filter = {}
+
+    if params.apply_product_theme_filter:
+        product_theme = params.product_theme
+        query_filter['theme'] = product_theme.value
+
+    if params.apply_product_attribute_sort:
+        key = sort_key(params.product_attribute_to_sort)
+        descending = params.descending
+    else:
+        key = '_id'
+        descending = False
+
+    return query_filter, key, descending
+
+
+def search_query(params: SearchParams) -> tuple[dict, dict]:
+    '''
+    Translate the search settings into a query filter and a sort
+    specification. Text searches are sorted by relevance by default.
+    '''
+    query_filter = {}
+
+    if params.text:
+        query_filter['$text'] = {'$search': params.text}
+    if params.product_themes:
+        query_filter['theme'] = {
+            '$in': [theme.value for theme in params.product_themes]
+        }
+
+    price_filter = {}
+    if params.min_price is not None:
+        price_filter['$gte'] = params.min_price
+    if params.max_price is not None:
+        price_filter['$lte'] = params.max_price
+    if price_filter:
+        query_filter['price'] = price_filter
+
+    if params.in_stock:
+        query_filter['quantity'] = {'$gt': 0}
+
+    if params.product_attribute_to_sort is not None:
+        key = sort_key(params.product_attribute_to_sort)
+        sort = dict(sort_spec(key, params.descending))
+    elif params.text:
+        sort = {'score': {'$meta': 'textScore'}, '_id': 1}
+    else:
+        sort = {'_id': 1}
+
+    return query_filter, sort
+
+
+def price_facets(buckets: list) -> list:
+    '''Shape the $bucket results of the price facet as returned.'''
+    upper_bounds = dict(zip(
+        PRICE_FACET_BOUNDARIES,
+        PRICE_FACET_BOUNDARIES[1:] + [None]
+    ))
+    return [
+        {
+            'min_price': bucket['_id'],
+            'max_price': upper_bounds[bucket['_id']],
+            'count': bucket['count']
+        }
+        for bucket in buckets
+        if bucket['_id'] in upper_bounds
+    ]
+
 
 @router.post("/api/products/", status_code=status.HTTP_201_CREATED)
 async def create_product(product_data: Product) -> CreateOutput:
     '''Endpoint used to create a new product.'''
-    product = await create_obj(products_collection, dict(product_data))
+    product = await create_obj(
+        mongo.products_collection,
+        {**dict(product_data), 'version': 1}
+    )
+    products_cache.invalidate(product.inserted_id)
 
     return {'id': str(product.inserted_id)}
 
 
+def bulk_error(index: int, detail: str, id: str = None) -> dict:
+    '''Result of a bulk operation rejected before reaching the database.'''
+    return {
+        'index': index,
+        'id': id,
+        'status_code': status.HTTP_422_UNPROCESSABLE_ENTITY,
+        'detail': detail
+    }
+
+
+async def execute_bulk_chunk(chunk: list) -> list:
+    '''
+    Execute a chunk of validated bulk operations, given as tuples of
+    (index, operation, product_id), with a single unordered bulk_write.
+    Products deleted by the chunk are removed from all shopping carts,
+    and new prices are copied to the shopping carts, with a single update
+    each. Returns the result of each operation.
+    '''
+    target_ids = [
+        product_id for _, operation, product_id in chunk
+        if operation.operation != BulkOperationType.CREATE
+    ]
+    existing_products = {}
+    if target_ids:
+        existing_products = await find_objs_by_ids(
+            mongo.products_collection,
+            target_ids,
+            PRODUCT_PRICE_PROJECTION
+        )
+
+    results = []
+    requests = []
+    request_results = []
+    for index, operation, product_id in chunk:
+        if operation.operation == BulkOperationType.CREATE:
+            product_id = ObjectId()
+            requests.append(
+                InsertOne({
+                    '_id': product_id,
+                    **dict(operation.product),
+                    'version': 1
+                })
+            )
+            status_code = status.HTTP_201_CREATED
+        elif product_id not in existing_products:
+            results.append({
+                'index': index,
+                'id': str(product_id),
+                'status_code': status.HTTP_404_NOT_FOUND,
+                'detail': "Product not found"
+            })
+            continue
+        elif operation.operation == BulkOperationType.UPDATE:
+            requests.append(UpdateOne(
+                {'_id': product_id},
+                {
+                    '$set': dict(operation.product),
+                    '$inc': PRODUCT_VERSION_INCREMENT
+                }
+            ))
+            status_code = status.HTTP_200_OK
+        else:
+            requests.append(DeleteOne({'_id': product_id}))
+            status_code = status.HTTP_204_NO_CONTENT
+
+        request_results.append({
+            'index': index,
+            'id': str(product_id),
+            'status_code': status_code
+        })
+
+    if requests:
+        try:
+            await mongo.products_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                is_duplicate = write_error['code'] == DUPLICATE_KEY_ERROR
+                request_results[write_error['index']].update({
+                    'status_code': (
+                        status.HTTP_409_CONFLICT if is_duplicate
+                        else status.HTTP_500_INTERNAL_SERVER_ERROR
+                    ),
+                    'detail': write_error['errmsg']
+                })
+
+    deleted_ids = []
+    for result in request_results:
+        products_cache.invalidate(ObjectId(result['id']))
+        if result['status_code'] == status.HTTP_204_NO_CONTENT:
+            deleted_ids.append(ObjectId(result['id']))
+
+    new_prices = {}
+    for index, operation, product_id in chunk:
+        if (operation.operation == BulkOperationType.UPDATE
+                and product_id in existing_products
+                and existing_products[product_id].get('price')
+                != operation.product.price):
+            new_prices[product_id] = operation.product.price
+    for result in request_results:
+        if result['status_code'] != status.HTTP_200_OK:
+            new_prices.pop(ObjectId(result['id']), None)
+
+    if new_prices:
+        await update_cart_prices(
+            mongo.shopping_carts_collection,
+            new_prices
+        )
+
+    if deleted_ids:
+        await remove_products_from_carts(
+            mongo.shopping_carts_collection,
+            deleted_ids
+        )
+        await drop_product_reservations(deleted_ids)
+
+    return results + request_results
+
+
+@router.post("/api/products/bulk", status_code=status.HTTP_200_OK)
+async def bulk_write_products(
+        request: Request) -> List[BulkOperationOutput]:
+    '''
+    Endpoint used to create, update and delete many products at once.
+    The body is a JSON array of operations or, when sent as
+    application/x-ndjson, one operation per line. Each operation looks
+    like {"operation": "create" | "update" | "delete", "id": ...,
+    "product": {...}}. Operations are applied unordered, in chunks, so a
+    product should appear only once in the same request. The response
+    brings the status code of each operation, in the order they were sent.
+    '''
+    results = []
+    chunk = []
+    index = -1
+
+    async for item in iter_request_items(request):
+        index += 1
+        if item is INVALID_JSON:
+            results.append(bulk_error(index, "Invalid JSON"))
+            continue
+
+        try:
+            operation = BulkProductOperationInput.model_validate(item)
+        except ValidationError as error:
+            results.append(bulk_error(index, error.errors()[0]['msg']))
+            continue
+
+        product_id = None
+        if operation.id is not None:
+            try:
+                product_id = ObjectId(operation.id)
+            except Exception:
+                results.append(
+                    bulk_error(index, "Product not valid", operation.id)
+                )
+                continue
+
+        chunk.append((index, operation, product_id))
+        if len(chunk) >= BULK_WRITE_CHUNK_SIZE:
+            results.extend(await execute_bulk_chunk(chunk))
+            chunk = []
+
+    if chunk:
+        results.extend(await execute_bulk_chunk(chunk))
+
+    return sorted(results, key=lambda result: result['index'])
+
+
 @router.get("/api/products/", status_code=status.HTTP_200_OK)
 async def get_products(
-        skip: int,
+        request: Request,
+        response: Response,
         limit: int,
+        skip: int = 0,
+        cursor: Optional[str] = None,
         params: QueryParams = Depends()) -> List[GetProductOutput]:
     '''
     Endpoint used to retrieve many products, according to the pagination,
     sorting and filtering settings. This endpoint can't return more than
     200 registers by default. This value can be changed in .env file.
+    Pages can be requested either with skip or with the cursor returned
+    in the X-Next-Cursor header of the previous page. The cursor doesn't
+    make MongoDB walk the skipped products, so it should be preferred
+    for deep pages. Pages carry an ETag, and a request whose
+    If-None-Match still matches gets a 304 without the page being
+    serialized again.
     '''
     if limit > MAX_PAGE_SIZE:
         raise HTTPException(
@@ -45,109 +386,290 @@ async def get_products(
             detail="The number of registers in a page cannot exceed 200."
         )
 
-    query_filter = {}
-    
-    if params.apply_product_theme_filter:
-        product_theme = params.product_theme
-        query_filter['theme'] = product_theme.value
-    
-    products = products_collection.find(query_filter).skip(skip).limit(limit)
+    query_filter, key, descending = products_query(params)
 
-    if params.apply_product_attribute_sort:
-        column_name = params.product_attribute_to_sort.value
-        descending_value = -1 if params.descending else 1
-        sort_filter = {column_name: descending_value}
-        products = products.sort(sort_filter)
-    
-    response = []
-
-    async for product in products:
-        product_dict = {
-            'id': str(product['_id']),
-            'name': product['name'],
-            'theme': product['theme'],
-            'price': product['price'],
-            'quantity': product['quantity']
-        }
-        response.append(product_dict)
+    if cursor is not None:
+        if skip:
+            raise HTTPException(
+                status_code=422,
+                detail="Cursor and skip cannot be used together."
+            )
+        query_filter.update(keyset_filter(cursor, key, descending))
+
+    if FAST_JSON_RESPONSES:
+        response_products = await find_output_page(
+            mongo.catalog_products_collection,
+            query_filter,
+            sort_spec(key, descending),
+            skip,
+            limit,
+            PRODUCT_VERSION_OUTPUT_PROJECTION
+        )
+        headers = cache_headers(
+            page_etag(request, [
+                (product['id'], product.pop('version', 0))
+                for product in response_products
+            ]),
+            PRODUCT_LIST_CACHE_CONTROL
+        )
+        if is_not_modified(request, headers[ETAG_HEADER]):
+            return not_modified_response(headers)
+        if response_products and len(response_products) == limit:
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(
+                key,
+                descending,
+                output_as_document(response_products[-1])
+            )
+        return fast_json_response(response_products, headers)
+
+    products = mongo.catalog_products_collection.find(
+        query_filter,
+        PRODUCT_VERSION_PROJECTION
+    )
+    products = products.sort(sort_spec(key, descending))
+    products = products.skip(skip).limit(limit)
+    products = await products.to_list(length=None)
+
+    headers = cache_headers(
+        page_etag(request, [
+            (product['_id'], product.get('version', 0))
+            for product in products
+        ]),
+        PRODUCT_LIST_CACHE_CONTROL
+    )
+    if is_not_modified(request, headers[ETAG_HEADER]):
+        return not_modified_response(headers)
+    response.headers.update(headers)
+
+    response_products = [product_output(product) for product in products]
+    last_product = products[-1] if products else None
+
+    if last_product is not None and len(response_products) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            key,
+            descending,
+            last_product
+        )
 
-    return response
+    return response_products
+
+
+@router.get("/api/products/export", status_code=status.HTTP_200_OK)
+async def export_products(
+        batch_size: int = EXPORT_BATCH_SIZE,
+        params: QueryParams = Depends()) -> StreamingResponse:
+    '''
+    Endpoint used to export all products as newline delimited JSON,
+    according to the sorting and filtering settings. Products are
+    streamed straight from the database in batches of batch_size, so
+    the whole catalog can be exported with a single request.
+    '''
+    if batch_size < 1:
+        raise HTTPException(
+            status_code=422,
+            detail="The batch size must be a positive number."
+        )
+
+    query_filter, key, descending = products_query(params)
+    products = mongo.catalog_products_collection.find(
+        query_filter,
+        PRODUCT_PROJECTION
+    )
+    products = products.sort(sort_spec(key, descending))
+    products = products.batch_size(batch_size)
+
+    return StreamingResponse(
+        stream_ndjson(products, product_output, batch_size),
+        media_type=NDJSON_MEDIA_TYPE
+    )
+
+
+@router.get("/api/products/search", status_code=status.HTTP_200_OK)
+async def search_products(
+        limit: int,
+        skip: int = 0,
+        params: SearchParams = Depends()) -> SearchProductsOutput:
+    '''
+    Endpoint used to search products by words in their names, themes,
+    price range and stock. Besides a page of the matching products, it
+    returns how many products match in total, per theme and per price
+    range, all computed by a single aggregation.
+    '''
+    if limit > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail="The number of registers in a page cannot exceed 200."
+        )
+
+    if (params.min_price is not None and params.max_price is not None
+            and params.min_price > params.max_price):
+        raise HTTPException(
+            status_code=422,
+            detail="The minimum price cannot exceed the maximum price."
+        )
+
+    query_filter, sort = search_query(params)
+    pipeline = [
+        {'$match': query_filter},
+        {'$facet': {
+            'products': [
+                {'$sort': sort},
+                {'$skip': skip},
+                {'$limit': limit},
+                {'$project': PRODUCT_OUTPUT_PROJECTION}
+            ],
+            'total': [{'$count': 'count'}],
+            'themes': [
+                {'$group': {'_id': '$theme', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}}
+            ],
+            'prices': [
+                {'$bucket': {
+                    'groupBy': '$price',
+                    'boundaries': PRICE_FACET_BOUNDARIES + [float('inf')],
+                    'default': 'other',
+                    'output': {'count': {'$sum': 1}}
+                }}
+            ]
+        }}
+    ]
+    results = await mongo.catalog_products_collection.aggregate(
+        pipeline
+    ).to_list(length=None)
+    facets = results[0]
+
+    return {
+        'total': facets['total'][0]['count'] if facets['total'] else 0,
+        'products': facets['products'],
+        'theme_facets': [
+            {'theme': theme['_id'], 'count': theme['count']}
+            for theme in facets['themes']
+        ],
+        'price_facets': price_facets(facets['prices'])
+    }
 
 
 @router.get("/api/products/{product_id}", status_code=status.HTTP_200_OK)
-async def find_product_by_id(product_id: str) -> GetProductOutput:
-    '''Endpoint used to retrieve a single product by its identifier.'''
+async def find_product_by_id(
+        request: Request,
+        response: Response,
+        product_id: str) -> GetProductOutput:
+    '''
+    Endpoint used to retrieve a single product by its identifier.
+    The product carries an ETag, and a request whose If-None-Match still
+    matches gets a 304 without the product being serialized again.
+    '''
     try:
         id = ObjectId(product_id)
     except Exception:
         raise HTTPException(status_code=422, detail="Product not valid")
     
-    try:
-        product = await find_obj_by_id(products_collection, id)
-        response = {
-            'id': str(product['_id']),
-            'name': product['name'],
-            'theme': product['theme'],
-            'price': product['price'],
-            'quantity': product['quantity']
-        }
-    except Exception:
+    product = await find_cached_obj_by_id(
+        products_cache,
+        mongo.products_collection,
+        id,
+        PRODUCT_CACHE_PROJECTION
+    )
+    if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    return response
+    headers = cache_headers(document_etag(product), PRODUCT_CACHE_CONTROL)
+    if is_not_modified(request, headers[ETAG_HEADER]):
+        return not_modified_response(headers)
+
+    response.headers.update(headers)
+    if FAST_JSON_RESPONSES:
+        return fast_json_response(product_output(product), headers)
+
+    return product_output(product)
 
 
 @router.delete("/api/products/{product_id}",
-               status_code=status.HTTP_204_NO_CONTENT)
-async def delete_product_by_id(product_id: str):
+               status_code=status.HTTP_204_NO_CONTENT,
+               responses={
+                   status.HTTP_202_ACCEPTED: {'model': CreateJobOutput}
+               })
+async def delete_product_by_id(product_id: str, background: bool = False):
     '''
     Endpoint used to delete a single product by its identifier.
     When deleting a product already being used in shopping carts,
     this method ensures that all references of the excluded product
-    are deleted from existing shopping carts.
+    are deleted from existing shopping carts, with a single statement.
+    With background=true, the deletion runs as a background job and the
+    endpoint answers 202 with the job identifier, whose status can be
+    followed in GET /api/jobs/{job_id}.
     '''
     try:
         id = ObjectId(product_id)
     except Exception:
         raise HTTPException(status_code=422, detail="Product not valid")
 
-    try:
-        product = await find_obj_by_id(products_collection, id)
-        await delete_obj(products_collection, product['_id'])
-    except Exception: 
+    if background:
+        product = await find_obj_by_id(
+            mongo.products_collection,
+            id,
+            ID_PROJECTION
+        )
+        if product is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        async def delete_in_background():
+            deleted = await run_cascade(delete_product_cascade, id)
+            products_cache.invalidate(id)
+            return deleted
+
+        job_id = await start_job(
+            'delete_product',
+            id,
+            delete_in_background()
+        )
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content=CreateJobOutput(job_id=job_id).model_dump()
+        )
+
+    if not await run_cascade(delete_product_cascade, id):
         raise HTTPException(status_code=404, detail="Product not found")
 
-    shopping_carts = shopping_carts_collection.find(
-        {"products": {"$elemMatch": {"product_id": ObjectId(product_id)}}}
-    )
-    async for shopping_cart in shopping_carts:
-        for product in shopping_cart['products']:
-            if product['product_id'] == ObjectId(product_id):
-                shopping_cart['products'].remove(product)
-                await update_obj(shopping_carts_collection, shopping_cart['_id'], shopping_cart)
-                break
+    products_cache.invalidate(id)
 
 
 @router.put("/api/products/{product_id}", status_code=status.HTTP_200_OK)
 async def update_product_data_by_id(
         product_id: str,
         product_data: Product) -> UpdateOutput:
-    '''Endpoint used to update all data of given product.'''
+    '''
+    Endpoint used to update all data of given product.
+    If the price changes, the unit price snapshots and totals of the
+    shopping carts holding the product are updated as well.
+    '''
     try:
         id = ObjectId(product_id)
     except Exception:
         raise HTTPException(status_code=422, detail="Product not valid")
 
     try:
-        product = await find_obj_by_id(products_collection, id)
+        product = await find_obj_by_id(
+            mongo.products_collection,
+            id,
+            PRODUCT_PRICE_PROJECTION
+        )
         await update_obj(
-            products_collection,
+            mongo.products_collection,
             product['_id'],
-            dict(product_data)
+            dict(product_data),
+            PRODUCT_VERSION_INCREMENT
         )
     except Exception:
         raise HTTPException(status_code=404, detail="Product not found")
 
+    products_cache.invalidate(id)
+    if product.get('price') != product_data.price:
+        await update_cart_prices(
+            mongo.shopping_carts_collection,
+            {id: product_data.price}
+        )
+
     return {'message': 'Product updated successfully'}
 
 
@@ -158,14 +680,20 @@ async def update_product_stock_by_product_id(
     '''Endpoint used to change the stock of a given product.'''
     try:
         id = ObjectId(product_id)
-        product = await find_obj_by_id(products_collection, id)
-        product['quantity'] = product_data.quantity
+        product = await find_obj_by_id(
+            mongo.products_collection,
+            id,
+            ID_PROJECTION
+        )
         await update_obj(
-            products_collection,
+            mongo.products_collection,
             product['_id'],
-            product
+            {'quantity': product_data.quantity},
+            PRODUCT_VERSION_INCREMENT
         )
     except Exception:
         raise HTTPException(status_code=404, detail="Product not found")
 
+    products_cache.invalidate(id)
+
     return {'message': 'Product stock updated successfully'}
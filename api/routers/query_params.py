@@ -1,3 +1,5 @@
+from typing import List, Optional
+from fastapi import Query
 from pydantic import BaseModel, Field
 from api.enums import ProductType, SortableProductFields
 
@@ -15,3 +17,23 @@ class QueryParams(BaseModel):
     )
     apply_product_attribute_sort: bool = False
     descending: bool = False
+
+
+class SearchParams(BaseModel):
+    '''All query parameters used in /api/products/search GET endpoint.'''
+    text: Optional[str] = Field(
+        default=None,
+        description="Words searched in the product names",
+    )
+    product_themes: List[ProductType] = Field(
+        Query(default=[], description="Product themes to search in")
+    )
+    min_price: Optional[float] = Field(default=None, ge=0)
+    max_price: Optional[float] = Field(default=None, ge=0)
+    in_stock: bool = False
+    product_attribute_to_sort: Optional[SortableProductFields] = Field(
+        default=None,
+        description="Enum for sortable product fields parameters, "
+                    "the relevance of the text search by default",
+    )
+    descending: bool = False
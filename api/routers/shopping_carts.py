@@ -1,27 +1,53 @@
 from typing import List
 from bson import ObjectId
 from fastapi import APIRouter, HTTPException, status
+from api.constants import CART_UPDATE_MAX_RETRIES
 from api.db.actions import (
+    ID_PROJECTION,
     create_obj,
     delete_obj,
-    find_obj_by_id,
-    update_obj
+    find_obj_by_id
 )
-from api.db.models import ProductInCart
-from api.db.settings import (
-    products_collection,
-    shopping_carts_collection,
-    users_collection
+from api.db.cache import (
+    PRODUCT_CACHE_PROJECTION,
+    find_cached_objs_by_ids,
+    products_cache
+)
+from api.db.cart_actions import (
+    CartVersionConflict,
+    EMPTY_CART_FIELDS,
+    apply_cart_changes,
+    clear_cart,
+    find_cart,
+    find_cart_with_products
 )
+from api.db.checkout import checkout_cart
+from api.db.reservations import (
+    InsufficientStock,
+    release,
+    release_carts,
+    reserve
+)
+from api.db.models import ProductInCart
+from api.db.settings import mongo
 from api.db.schemas import (
     CreateOutput,
     GetShoppingCartOutput,
+    GetShoppingCartViewOutput,
     CreateEmptyShoppingCartInput,
     UpdateOutput
 )
 
 router = APIRouter()
 
+SHOPPING_CART_OUTPUT_PROJECTION = {
+    'user_id': 1,
+    'products': 1,
+    'item_count': 1,
+    'subtotal': 1
+}
+SHOPPING_CART_MUTATION_PROJECTION = {'products': 1, 'version': 1}
+
 
 @router.post("/api/shopping_carts/", status_code=status.HTTP_201_CREATED)
 async def create_shopping_cart(
@@ -29,7 +55,7 @@ async def create_shopping_cart(
         ) -> CreateOutput:
     '''Endpoint used to create an empty shopping cart linked to an user.'''
     shopping_cart_dict = dict(shopping_cart_data)
-    shopping_cart_dict['products'] = []
+    shopping_cart_dict.update(EMPTY_CART_FIELDS)
 
     try:
         user_id = ObjectId(shopping_cart_dict['user_id'])
@@ -37,12 +63,12 @@ async def create_shopping_cart(
     except Exception:
         raise HTTPException(status_code=422, detail="User not valid")
 
-    user = await find_obj_by_id(users_collection, user_id)
+    user = await find_obj_by_id(mongo.users_collection, user_id, ID_PROJECTION)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     shopping_cart = await create_obj(
-        shopping_carts_collection,
+        mongo.shopping_carts_collection,
         shopping_cart_dict
     )
 
@@ -59,39 +85,162 @@ async def get_shopping_cart_by_id(
     except Exception:
         raise HTTPException(status_code=422, detail="Shopping cart not valid")
 
+    shopping_cart = await find_cart(
+        mongo.shopping_carts_collection,
+        mongo.users_collection,
+        id,
+        SHOPPING_CART_OUTPUT_PROJECTION
+    )
+    if shopping_cart is None:
+        raise HTTPException(status_code=404, detail="Shopping cart not found")
+
+    return shopping_cart_output(shopping_cart)
+
+
+@router.get("/api/users/{user_id}/shopping_cart",
+            status_code=status.HTTP_200_OK)
+async def get_shopping_cart_by_user_id(
+        user_id: str) -> GetShoppingCartOutput:
+    '''
+    Endpoint used to retrieve the shopping cart of a user. Users who
+    never added anything to their cart get an empty one.
+    '''
     try:
-        shopping_cart = await find_obj_by_id(shopping_carts_collection, id)
-        shopping_cart_products = shopping_cart['products']
+        id = ObjectId(user_id)
     except Exception:
-        raise HTTPException(status_code=404, detail="Shopping cart not found")
+        raise HTTPException(status_code=422, detail="User not valid")
 
-    for product in shopping_cart_products:
-        product['product_id'] = str(product['product_id'])
+    shopping_cart = await find_cart(
+        mongo.shopping_carts_collection,
+        mongo.users_collection,
+        id,
+        SHOPPING_CART_OUTPUT_PROJECTION
+    )
+    if shopping_cart is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # Users created before carts were lazy have a cart with its own id.
+    if shopping_cart.get('lazy'):
+        shopping_cart = await mongo.shopping_carts_collection.find_one(
+            {"user_id": id},
+            SHOPPING_CART_OUTPUT_PROJECTION
+        ) or shopping_cart
+
+    return shopping_cart_output(shopping_cart)
 
-    response = {
+
+def shopping_cart_output(shopping_cart: dict) -> dict:
+    '''Shape a shopping cart as returned by the GET endpoints.'''
+    return {
         'id': str(shopping_cart['_id']),
         'user_id': str(shopping_cart['user_id']),
-        'products': shopping_cart['products']
+        'products': [
+            {**product, 'product_id': str(product['product_id'])}
+            for product in shopping_cart['products']
+        ],
+        'item_count': shopping_cart.get('item_count', 0),
+        'subtotal': round(shopping_cart.get('subtotal', 0), 2)
     }
 
-    return response
+
+def shopping_cart_view(shopping_cart: dict) -> dict:
+    '''
+    Shape a shopping cart joined with its products as returned by the
+    view endpoint, with the line totals, the subtotal and the lines
+    asking for more units than there are in stock.
+    '''
+    products = {
+        product['_id']: product for product in shopping_cart['product_docs']
+    }
+    lines = []
+    for product_in_cart in shopping_cart['products']:
+        product = products.get(product_in_cart['product_id'], {})
+        quantity = product_in_cart['quantity']
+        unit_price = product.get('price')
+        stock = product.get('quantity', 0)
+        lines.append({
+            'product_id': str(product_in_cart['product_id']),
+            'name': product.get('name'),
+            'unit_price': unit_price,
+            'quantity': quantity,
+            'line_total': round((unit_price or 0) * quantity, 2),
+            'stock': stock,
+            'exceeds_stock': quantity > stock
+        })
+
+    return {
+        'id': str(shopping_cart['_id']),
+        'user_id': str(shopping_cart['user_id']),
+        'lines': lines,
+        'item_count': sum(line['quantity'] for line in lines),
+        'subtotal': round(sum(line['line_total'] for line in lines), 2),
+        'exceeds_stock': any(line['exceeds_stock'] for line in lines)
+    }
+
+
+@router.get("/api/shopping_carts/{shopping_cart_id}/view",
+            status_code=status.HTTP_200_OK)
+async def get_shopping_cart_view_by_id(
+        shopping_cart_id: str) -> GetShoppingCartViewOutput:
+    '''
+    Endpoint used to retrieve a shopping cart ready to be rendered: each
+    line brings the name, unit price and stock of its product, its total
+    and whether it exceeds the current stock, and the cart brings its
+    item count and subtotal. Products are joined by the database in the
+    same query, so no request per line is needed.
+    '''
+    try:
+        id = ObjectId(shopping_cart_id)
+    except Exception:
+        raise HTTPException(status_code=422, detail="Shopping cart not valid")
+
+    shopping_cart = await find_cart_with_products(
+        mongo.shopping_carts_collection,
+        id,
+        mongo.products_collection.name
+    )
+    if shopping_cart is None:
+        shopping_cart = await find_cart(
+            mongo.shopping_carts_collection,
+            mongo.users_collection,
+            id,
+            ID_PROJECTION
+        )
+        if shopping_cart is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Shopping cart not found"
+            )
+        shopping_cart['product_docs'] = []
+
+    return shopping_cart_view(shopping_cart)
 
 
 @router.delete("/api/shopping_carts/{shopping_cart_id}",
                status_code=status.HTTP_204_NO_CONTENT)
 async def delete_shopping_cart_by_id(shopping_cart_id: str):
-    '''Endpoint used to delete a shopping cart.'''
+    '''
+    Endpoint used to delete a shopping cart. A user whose own cart is
+    deleted gets an empty one back, since every user has one.
+    '''
     try:
         id = ObjectId(shopping_cart_id)
     except Exception:
         raise HTTPException(status_code=422, detail="Shopping cart not valid")
 
-    try:
-        shopping_cart = await find_obj_by_id(shopping_carts_collection, id)
-        await delete_obj(shopping_carts_collection, shopping_cart['_id'])
-    except Exception:
+    shopping_cart = await find_cart(
+        mongo.shopping_carts_collection,
+        mongo.users_collection,
+        id,
+        ID_PROJECTION
+    )
+    if shopping_cart is None:
         raise HTTPException(status_code=404, detail="Shopping cart not found")
-    
+
+    if not shopping_cart.get('lazy'):
+        await delete_obj(mongo.shopping_carts_collection, id)
+    await release_carts([id])
+
 
 @router.patch("/api/shopping_carts/{shopping_cart_id}/clear",
               status_code=status.HTTP_200_OK)
@@ -100,16 +249,22 @@ async def clear_shopping_cart(
     '''Endpoint used to remove all items from a shopping cart.'''
     try:
         id = ObjectId(shopping_cart_id)
-        shopping_cart = await find_obj_by_id(shopping_carts_collection, id)
-        shopping_cart['products'] = []
-        await update_obj(
-            shopping_carts_collection,
-            shopping_cart['_id'],
-            shopping_cart
-        )
     except Exception:
         raise HTTPException(status_code=404, detail="Shopping cart not found")
 
+    shopping_cart = await clear_cart(mongo.shopping_carts_collection, id)
+    if shopping_cart is None:
+        shopping_cart = await find_cart(
+            mongo.shopping_carts_collection,
+            mongo.users_collection,
+            id,
+            ID_PROJECTION
+        )
+    if shopping_cart is None:
+        raise HTTPException(status_code=404, detail="Shopping cart not found")
+
+    await release_carts([id])
+
     return {'message': 'Shopping cart cleared successfully'}
 
 
@@ -124,61 +279,81 @@ async def add_items_to_shopping_cart(
         1. If the shopping cart exists in the database
         2. If the product exists in the database
         3. If the product has enough stock to be added to the cart
-    If all validations are successful, the cart will add all the items
-    specified in the request's body.
+    If all validations are successful, the added units are reserved for
+    the cart and the cart will add all the items specified in the
+    request's body. Only the changed lines are written, and the whole
+    operation is retried if the cart changes concurrently.
     '''
     try:
         id = ObjectId(shopping_cart_id)
     except Exception:
         raise HTTPException(status_code=422, detail="Shopping cart not valid")
-    
+
     try:
-        shopping_cart = await find_obj_by_id(shopping_carts_collection, id)
-        current_products_in_cart = shopping_cart['products']
+        product_ids = [
+            ObjectId(product_data.product_id)
+            for product_data in products_data
+        ]
     except Exception:
-        raise HTTPException(status_code=404, detail="Shopping cart not found")
-    
-    for product_data in products_data:
-        product_data.product_id = ObjectId(product_data.product_id)
-        try:
-            id = product_data.product_id
-            product = await find_obj_by_id(products_collection, id)
-            product_quantity_in_stock = product['quantity'] 
-        except Exception:
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        is_product_already_in_cart = False
-        quantity = product_data.quantity
-        for product_in_cart in current_products_in_cart:
-            if product_data.product_id == product_in_cart['product_id']:
-                quantity += product_in_cart['quantity']
-                is_product_already_in_cart = True
-                break
-        
-        if quantity > product_quantity_in_stock:
-            product_id = product_data.product_id
-            msg = f"Product with ID {product_id} doesn't have enough stock"
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    products = await find_cached_objs_by_ids(
+        products_cache,
+        mongo.products_collection,
+        product_ids,
+        PRODUCT_CACHE_PROJECTION
+    )
+    if any(product_id not in products for product_id in product_ids):
+        raise HTTPException(status_code=404, detail="Product not found")
+    unit_prices = {
+        product_id: product['price']
+        for product_id, product in products.items()
+    }
+
+    quantity_changes = {}
+    for product_id, product_data in zip(product_ids, products_data):
+        quantity_changes[product_id] = (
+            quantity_changes.get(product_id, 0) + product_data.quantity
+        )
+
+    try:
+        await reserve(id, quantity_changes)
+    except InsufficientStock as error:
+        product_id = error.product_ids[0]
+        msg = f"Product with ID {product_id} doesn't have enough stock"
+        raise HTTPException(status_code=422, detail=msg)
+
+    for _ in range(CART_UPDATE_MAX_RETRIES):
+        shopping_cart = await find_cart(
+            mongo.shopping_carts_collection,
+            mongo.users_collection,
+            id,
+            SHOPPING_CART_MUTATION_PROJECTION
+        )
+        if shopping_cart is None:
+            await release(id, quantity_changes)
             raise HTTPException(
-                status_code=422,
-                detail=msg
+                status_code=404,
+                detail="Shopping cart not found"
             )
-        
-        if not is_product_already_in_cart:
-            current_products_in_cart.append({
-                'product_id': product_data.product_id,
-                'quantity': product_data.quantity
-            })
-        else:
-            product_in_cart['quantity'] = quantity
-    
-    shopping_cart['products'] = current_products_in_cart
-    await update_obj(
-        shopping_carts_collection,
-        shopping_cart['_id'],
-        shopping_cart
-    )
 
-    return {'message': 'Items were added to shopping cart successfully'}
+        try:
+            await apply_cart_changes(
+                mongo.shopping_carts_collection,
+                shopping_cart,
+                quantity_changes,
+                unit_prices
+            )
+        except CartVersionConflict:
+            continue
+
+        return {'message': 'Items were added to shopping cart successfully'}
+
+    await release(id, quantity_changes)
+    raise HTTPException(
+        status_code=409,
+        detail="Shopping cart was modified concurrently"
+    )
 
 
 @router.patch("/api/shopping_carts/{shopping_cart_id}/remove_item",
@@ -193,58 +368,157 @@ async def remove_items_from_shopping_cart(
         2. If the product exists in the database
         3. If the product is in the given cart
     If all validations are successful, all specified items in the request's
-    body will be removed from the given shopping cart.
+    body will be removed from the given shopping cart. Only the changed
+    lines are written, and the whole operation is retried if the cart
+    changes concurrently. The removed units stop being reserved.
     '''
     try:
         id = ObjectId(shopping_cart_id)
-        shopping_cart = await find_obj_by_id(shopping_carts_collection, id)
-        current_products_in_cart = shopping_cart['products']
     except Exception:
         raise HTTPException(status_code=404, detail="Shopping cart not found")
-    
-    products_to_remove_from_cart = []
-    for product_data in products_data:
+
+    try:
+        product_ids = [
+            ObjectId(product_data.product_id)
+            for product_data in products_data
+        ]
+    except Exception:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    products = await find_cached_objs_by_ids(
+        products_cache,
+        mongo.products_collection,
+        product_ids,
+        PRODUCT_CACHE_PROJECTION
+    )
+    unit_prices = {
+        product_id: product['price']
+        for product_id, product in products.items()
+    }
+
+    for _ in range(CART_UPDATE_MAX_RETRIES):
         try:
-            id = ObjectId(product_data.product_id)
-            product = await find_obj_by_id(products_collection, id)
-            product_id = str(product['_id'])
+            shopping_cart = await find_cart(
+                mongo.shopping_carts_collection,
+                mongo.users_collection,
+                id,
+                SHOPPING_CART_MUTATION_PROJECTION
+            )
+            quantities_in_cart = {
+                product_in_cart['product_id']: product_in_cart['quantity']
+                for product_in_cart in shopping_cart['products']
+            }
         except Exception:
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        is_product_already_in_cart = False
-        quantity_in_cart = 0
-        for product_in_cart in current_products_in_cart:
-            if product_data.product_id == str(product_in_cart['product_id']):
-                quantity_in_cart = product_in_cart['quantity']
-                is_product_already_in_cart = True
-                break
-        
-        if not is_product_already_in_cart:
+            raise HTTPException(
+                status_code=404,
+                detail="Shopping cart not found"
+            )
+
+        quantity_changes = {}
+        for product_id, product_data in zip(product_ids, products_data):
+            if product_id not in products:
+                raise HTTPException(
+                    status_code=404,
+                    detail="Product not found"
+                )
+
+            if product_id not in quantities_in_cart:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Product isn't in shopping cart"
+                )
+
+            quantity_changes[product_id] = (
+                quantity_changes.get(product_id, 0) - product_data.quantity
+            )
+            quantity = (
+                quantities_in_cart[product_id] + quantity_changes[product_id]
+            )
+            if quantity < 0:
+                msg = f"Product with ID {product_id} has less units in cart"
+                raise HTTPException(
+                    status_code=422,
+                    detail=msg)
+
+        try:
+            await apply_cart_changes(
+                mongo.shopping_carts_collection,
+                shopping_cart,
+                quantity_changes,
+                unit_prices
+            )
+        except CartVersionConflict:
+            continue
+
+        await release(id, {
+            product_id: -delta
+            for product_id, delta in quantity_changes.items()
+        })
+        return {
+            'message': 'Items were removed from shopping cart successfully'
+        }
+
+    raise HTTPException(
+        status_code=409,
+        detail="Shopping cart was modified concurrently"
+    )
+
+
+@router.post("/api/shopping_carts/{shopping_cart_id}/checkout",
+             status_code=status.HTTP_200_OK)
+async def checkout_shopping_cart(shopping_cart_id: str) -> UpdateOutput:
+    '''
+    Endpoint used to check out a shopping cart.
+    The stock of every product in the cart is decreased atomically, so
+    concurrent checkouts can't sell more units than there are in stock,
+    and the cart is emptied. If any product doesn't have enough stock,
+    nothing changes and the response lists the short products.
+    '''
+    try:
+        id = ObjectId(shopping_cart_id)
+    except Exception:
+        raise HTTPException(status_code=422, detail="Shopping cart not valid")
+
+    for _ in range(CART_UPDATE_MAX_RETRIES):
+        shopping_cart = await find_cart(
+            mongo.shopping_carts_collection,
+            mongo.users_collection,
+            id,
+            SHOPPING_CART_MUTATION_PROJECTION
+        )
+        if shopping_cart is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Shopping cart not found"
+            )
+
+        if not shopping_cart['products']:
             raise HTTPException(
                 status_code=422,
-                detail="Product isn't in shopping cart"
+                detail="Shopping cart is empty"
             )
 
-        if quantity_in_cart < product_data.quantity:
-            msg = f"Product with ID {product_id} has less units in cart"
+        try:
+            await checkout_cart(shopping_cart)
+        except CartVersionConflict:
+            continue
+        except InsufficientStock as error:
             raise HTTPException(
                 status_code=422,
-                detail=msg)
+                detail={
+                    'message': "Some products don't have enough stock",
+                    'product_ids': [
+                        str(product_id) for product_id in error.product_ids
+                    ]
+                }
+            )
+        finally:
+            for product_in_cart in shopping_cart['products']:
+                products_cache.invalidate(product_in_cart['product_id'])
 
-        new_quantity = quantity_in_cart - product_data.quantity
-        if new_quantity == 0:
-            products_to_remove_from_cart.append(product_in_cart)
-        else:
-            product_in_cart['quantity'] = new_quantity
-    
-    for product in products_to_remove_from_cart:
-        current_products_in_cart.remove(product)
-    
-    shopping_cart['products'] = current_products_in_cart
-    await update_obj(
-        shopping_carts_collection,
-        shopping_cart['_id'],
-        shopping_cart
-    )
+        return {'message': 'Shopping cart checked out successfully'}
 
-    return {'message': 'Items were removed from shopping cart successfully'}
+    raise HTTPException(
+        status_code=409,
+        detail="Shopping cart was modified concurrently"
+    )
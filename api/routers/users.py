@@ -1,58 +1,120 @@
-from typing import List
+from typing import List, Optional
 from bson import ObjectId
-from fastapi import APIRouter, HTTPException, status
-from api.constants import MAX_PAGE_SIZE
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from api.constants import (
+    EXPORT_BATCH_SIZE,
+    FAST_JSON_RESPONSES,
+    MAX_PAGE_SIZE
+)
 from api.db.actions import (
+    ID_PROJECTION,
     create_obj,
-    delete_obj,
     find_obj_by_id,
     update_obj
 )
+from api.db.cascades import delete_user_cascade, run_cascade
+from api.db.jobs import start_job
 from api.db.models import User
-from api.db.settings import (
-    users_collection,
-    shopping_carts_collection
-)
+from api.db.settings import mongo
 from api.db.schemas import (
+    CreateJobOutput,
     CreateUserOutput,
     GetUserOutput,
+    ImportUsersOutput,
     UpdateOutput,
     UpdateUserPasswordInput
 )
+from api.passwords import password_hasher
+from api.routers.fast_json import (
+    fast_json_response,
+    find_output_page,
+    output_as_document,
+    output_projection
+)
+from api.routers.ndjson import (
+    CSV_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+    iter_csv_items,
+    iter_request_items,
+    stream_ndjson
+)
+from api.routers.pagination import (
+    NEXT_CURSOR_HEADER,
+    encode_cursor,
+    keyset_filter,
+    sort_spec
+)
+from api.user_import import import_users
 
 router = APIRouter()
 
+USER_PROJECTION = {'username': 1, 'email': 1}
+USER_OUTPUT_PROJECTION = output_projection(list(USER_PROJECTION))
+
+
+def user_output(user: dict) -> dict:
+    '''Shape a user document as returned by the GET endpoints.'''
+    return {
+        'id': str(user['_id']),
+        'username': user['username'],
+        'email': user['email']
+    }
+
 
 @router.post("/api/users/", status_code=status.HTTP_201_CREATED)
 async def create_user(user_data: User) -> CreateUserOutput:
     '''
     Endpoint used to create a new user.
-    It also creates a shopping cart linked to the new user.
+    The shopping cart of the new user shares its id and is only stored
+    once something is added to it. The password is stored hashed.
     '''
-    user = await create_obj(users_collection, dict(user_data))
-    shopping_cart_dict = {
-        "user_id": user.inserted_id,
-        "products": []
-    }
-    shopping_cart = await create_obj(
-        shopping_carts_collection,
-        shopping_cart_dict
-    )
+    user_dict = dict(user_data)
+    user_dict['password'] = await password_hasher.hash(user_data.password)
+    user = await create_obj(mongo.users_collection, user_dict)
 
     return {
         'id': str(user.inserted_id),
-        'shopping_cart_id': str(shopping_cart.inserted_id)
+        'shopping_cart_id': str(user.inserted_id)
     }
 
 
+@router.post("/api/users/import", status_code=status.HTTP_200_OK)
+async def import_users_in_bulk(
+        request: Request,
+        import_id: Optional[str] = None) -> ImportUsersOutput:
+    '''
+    Endpoint used to import many users at once. The body is a JSON
+    array of users, NDJSON with one user per line or, when sent as
+    text/csv, CSV with a header row.
+    Users are inserted in chunks as the body is received. Sending the
+    same body again with the import_id of the response resumes an
+    interrupted import where it stopped.
+    '''
+    if import_id is None:
+        import_id = str(ObjectId())
+
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith(CSV_MEDIA_TYPE):
+        items = iter_csv_items(request.stream())
+    else:
+        items = iter_request_items(request)
+
+    return await import_users(items, import_id)
+
+
 @router.get("/api/users/", status_code=status.HTTP_200_OK)
 async def get_users(
-        skip: int,
-        limit: int) -> List[GetUserOutput]:
+        response: Response,
+        limit: int,
+        skip: int = 0,
+        cursor: Optional[str] = None) -> List[GetUserOutput]:
     '''
     Endpoint used to retrieve many users, according to the pagination,
     sorting and filtering settings. This endpoint can't return more than
     200 registers by default. This value can be changed in .env file.
+    Pages can be requested either with skip or with the cursor returned
+    in the X-Next-Cursor header of the previous page.
     '''
     if limit > MAX_PAGE_SIZE:
         raise HTTPException(
@@ -60,19 +122,75 @@ async def get_users(
             detail="The number of registers in a page cannot exceed 200."
         )
 
-    users = users_collection.find().skip(skip).limit(limit)
+    query_filter = {}
+
+    if cursor is not None:
+        if skip:
+            raise HTTPException(
+                status_code=422,
+                detail="Cursor and skip cannot be used together."
+            )
+        query_filter.update(keyset_filter(cursor, '_id', False))
+
+    if FAST_JSON_RESPONSES:
+        response_users = await find_output_page(
+            mongo.catalog_users_collection,
+            query_filter,
+            sort_spec('_id', False),
+            skip,
+            limit,
+            USER_OUTPUT_PROJECTION
+        )
+        headers = {}
+        if response_users and len(response_users) == limit:
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(
+                '_id',
+                False,
+                output_as_document(response_users[-1])
+            )
+        return fast_json_response(response_users, headers)
 
-    response = []
+    users = mongo.catalog_users_collection.find(query_filter, USER_PROJECTION)
+    users = users.sort(sort_spec('_id', False)).skip(skip).limit(limit)
+
+    response_users = []
+    last_user = None
 
     async for user in users:
-        user_dict = {
-            'id': str(user['_id']),
-            'username': user['username'],
-            'email': user['email']
-        }
-        response.append(user_dict)
+        response_users.append(user_output(user))
+        last_user = user
 
-    return response
+    if last_user is not None and len(response_users) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            '_id',
+            False,
+            last_user
+        )
+
+    return response_users
+
+
+@router.get("/api/users/export", status_code=status.HTTP_200_OK)
+async def export_users(
+        batch_size: int = EXPORT_BATCH_SIZE) -> StreamingResponse:
+    '''
+    Endpoint used to export all users as newline delimited JSON.
+    Users are streamed straight from the database in batches of
+    batch_size, so all of them can be exported with a single request.
+    '''
+    if batch_size < 1:
+        raise HTTPException(
+            status_code=422,
+            detail="The batch size must be a positive number."
+        )
+
+    users = mongo.catalog_users_collection.find({}, USER_PROJECTION)
+    users = users.sort(sort_spec('_id', False)).batch_size(batch_size)
+
+    return StreamingResponse(
+        stream_ndjson(users, user_output, batch_size),
+        media_type=NDJSON_MEDIA_TYPE
+    )
 
 
 @router.get("/api/users/{user_id}", status_code=status.HTTP_200_OK)
@@ -80,12 +198,12 @@ async def find_user_by_id(user_id: str) -> GetUserOutput:
     '''Endpoint used to retrieve a single user by its identifier.'''
     try:
         id = ObjectId(user_id)
-        user = await find_obj_by_id(users_collection, id)
-        response = {
-            'id': str(user['_id']),
-            'username': user['username'],
-            'email': user['email']
-        }
+        user = await find_obj_by_id(
+            mongo.users_collection,
+            id,
+            USER_PROJECTION
+        )
+        response = user_output(user)
     except Exception:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -93,42 +211,62 @@ async def find_user_by_id(user_id: str) -> GetUserOutput:
 
 
 @router.delete("/api/users/{user_id}",
-               status_code=status.HTTP_204_NO_CONTENT)
-async def delete_user_by_id(user_id: str):
+               status_code=status.HTTP_204_NO_CONTENT,
+               responses={
+                   status.HTTP_202_ACCEPTED: {'model': CreateJobOutput}
+               })
+async def delete_user_by_id(user_id: str, background: bool = False):
     '''
     Endpoint used to delete a single user by its identifier.
     When deleting an user with shopping carts, this method ensures 
-    that all linked shopping carts are deleted as well.
+    that all linked shopping carts are deleted as well, with a single
+    statement. With background=true, the deletion runs as a background
+    job and the endpoint answers 202 with the job identifier, whose
+    status can be followed in GET /api/jobs/{job_id}.
     '''
     try:
         id = ObjectId(user_id)
     except Exception:
         raise HTTPException(status_code=422, detail="User not valid")
 
-    try:
-        user = await find_obj_by_id(users_collection, id)
-        await delete_obj(users_collection, user['_id'])
-    except Exception:
-        raise HTTPException(status_code=404, detail="User not found")
+    if background:
+        user = await find_obj_by_id(mongo.users_collection, id, ID_PROJECTION)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
 
-    shopping_carts = shopping_carts_collection.find(
-        {"user_id": ObjectId(user_id)}
-    )
-    async for shopping_cart in shopping_carts:
-        await delete_obj(shopping_carts_collection, shopping_cart['_id'])
+        job_id = await start_job(
+            'delete_user',
+            id,
+            run_cascade(delete_user_cascade, id)
+        )
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content=CreateJobOutput(job_id=job_id).model_dump()
+        )
+
+    if not await run_cascade(delete_user_cascade, id):
+        raise HTTPException(status_code=404, detail="User not found")
 
 
 @router.put("/api/users/{user_id}", status_code=status.HTTP_200_OK)
 async def update_user_data_by_id(
         user_id: str,
         user_data: User) -> UpdateOutput:
-    '''Endpoint used to update all data of given user.'''
+    '''
+    Endpoint used to update all data of given user.
+    The password is stored hashed. Hashing is slow on purpose, so it is
+    only done once the user is known to exist.
+    '''
     try:
         id = ObjectId(user_id)
-        user = await find_obj_by_id(users_collection, id)
-        await update_obj(users_collection, user['_id'], dict(user_data))
     except Exception:
         raise HTTPException(status_code=404, detail="User not found")
+    if await find_obj_by_id(mongo.users_collection, id, ID_PROJECTION) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    user_dict = dict(user_data)
+    user_dict['password'] = await password_hasher.hash(user_data.password)
+    await update_obj(mongo.users_collection, id, user_dict)
 
     return {'message': 'User updated successfully'}
 
@@ -137,13 +275,23 @@ async def update_user_data_by_id(
 async def update_user_password_by_user_id(
         user_id: str,
         user_data: UpdateUserPasswordInput) -> UpdateOutput:
-    '''Endpoint used to change the password of a given user.'''
+    '''
+    Endpoint used to change the password of a given user.
+    The password is stored hashed. Hashing is slow on purpose, so it is
+    only done once the user is known to exist.
+    '''
     try:
         id = ObjectId(user_id)
-        user = await find_obj_by_id(users_collection, id)
-        user['password'] = user_data.password
-        await update_obj(users_collection, user['_id'], user)
     except Exception:
         raise HTTPException(status_code=404, detail="User not found")
+    if await find_obj_by_id(mongo.users_collection, id, ID_PROJECTION) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    password_hash = await password_hasher.hash(user_data.password)
+    await update_obj(
+        mongo.users_collection,
+        id,
+        {'password': password_hash}
+    )
 
     return {'message': 'User password updated successfully'}
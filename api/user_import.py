@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import AsyncIterator
+
+sys.path.append('..')
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pydantic import ValidationError
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from api.constants import (
+    USER_IMPORT_CHUNK_SIZE,
+    USER_IMPORT_CONCURRENCY,
+    USER_IMPORT_HASH_WORKERS
+)
+from api.db.actions import DUPLICATE_KEY_ERROR
+from api.db.models import User
+from api.db.settings import mongo
+from api.passwords import PasswordHasher
+from api.routers.ndjson import (
+    INVALID_JSON,
+    iter_csv_items,
+    iter_ndjson_items
+)
+
+
+# Imports hash on a pool of their own, so the thousands of hashes queued
+# by an import never delay the ones of signups and password changes.
+import_password_hasher = PasswordHasher(USER_IMPORT_HASH_WORKERS)
+
+
+def import_object_id(id_prefix: bytes, index: int) -> ObjectId:
+    '''
+    Id of the user created for a row of an import. Ids are derived from
+    the row, so running a chunk again after a crash hits duplicate keys
+    instead of creating the same users twice. The prefix holds the time
+    the import started, so the ids sort like the rows and tell when they
+    were created.
+    '''
+    return ObjectId(id_prefix + index.to_bytes(5, 'big'))
+
+
+class ImportChunk:
+    '''Consecutive rows of an import, inserted together.'''
+
+    def __init__(self, number: int, start: int):
+        self.number = number
+        self.start = start
+        self.end = start
+        self.users = []
+        self.failed = 0
+
+
+class ImportProgress:
+    '''
+    Checkpoint of an import, kept in the user_imports collection. Chunks
+    finish out of order, so the checkpoint only moves past a chunk once
+    every chunk before it is done, and resuming never skips a row.
+    '''
+
+    def __init__(self, import_id: str, checkpoint: dict):
+        self.import_id = import_id
+        self.checkpoint = checkpoint
+        self._next_chunk = 0
+        self._done_chunks = {}
+
+    @classmethod
+    async def start(cls, import_id: str) -> 'ImportProgress':
+        '''Load the checkpoint of an import, creating it the first time.'''
+        collection = mongo.user_imports_collection
+        checkpoint = await collection.find_one_and_update(
+            {"_id": import_id},
+            {"$setOnInsert": {
+                "id_prefix": (
+                    int(datetime.now(timezone.utc).timestamp())
+                    .to_bytes(4, 'big') + os.urandom(3)
+                ),
+                "processed": 0,
+                "imported": 0,
+                "failed": 0,
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return cls(import_id, checkpoint)
+
+    @property
+    def id_prefix(self) -> bytes:
+        return bytes(self.checkpoint['id_prefix'])
+
+    async def chunk_done(self, chunk: ImportChunk, imported: int):
+        self._done_chunks[chunk.number] = chunk
+        processed = None
+        failed = 0
+        while self._next_chunk in self._done_chunks:
+            done_chunk = self._done_chunks.pop(self._next_chunk)
+            processed = done_chunk.end
+            failed += done_chunk.failed
+            self._next_chunk += 1
+
+        update = {"$inc": {"imported": imported, "failed": failed}}
+        if processed is not None:
+            # Updates of chunks finishing together may land in any order.
+            update["$max"] = {"processed": processed}
+        collection = mongo.user_imports_collection
+        self.checkpoint = await collection.find_one_and_update(
+            {"_id": self.import_id},
+            update,
+            return_document=ReturnDocument.AFTER
+        )
+
+
+async def _insert_new(collection: AsyncIOMotorCollection, docs: list) -> int:
+    '''Insert the documents which don't exist yet. Returns how many.'''
+    try:
+        result = await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as error:
+        if any(
+                write_error['code'] != DUPLICATE_KEY_ERROR
+                for write_error in error.details['writeErrors']):
+            raise
+        return error.details['nInserted']
+    return len(result.inserted_ids)
+
+
+async def _insert_chunk(
+        chunk: ImportChunk,
+        id_prefix: bytes,
+        hasher: PasswordHasher) -> int:
+    if not chunk.users:
+        return 0
+
+    password_hashes = await asyncio.gather(*(
+        hasher.hash(user.password) for _, user in chunk.users
+    ))
+    user_docs = [
+        {
+            "_id": import_object_id(id_prefix, index),
+            **dict(user),
+            "password": password_hash
+        }
+        for (index, user), password_hash in zip(chunk.users, password_hashes)
+    ]
+    return await _insert_new(mongo.users_collection, user_docs)
+
+
+async def import_users(
+        items: AsyncIterator,
+        import_id: str,
+        hasher: PasswordHasher = import_password_hasher) -> dict:
+    '''
+    Import users from a stream of items. Items are validated with the
+    User model and grouped in chunks of USER_IMPORT_CHUNK_SIZE rows,
+    whose users are inserted with one insert_many, with up to
+    USER_IMPORT_CONCURRENCY chunks in flight. Their shopping carts are
+    lazy, like the ones of users created one by one. Passwords are hashed
+    by hasher, by default on threads kept apart from the hashing of
+    interactive requests. Progress is checkpointed under import_id, so
+    importing the same items again with the same id resumes where it
+    stopped.
+    Returns a summary with the errors of the invalid rows.
+    '''
+    start = perf_counter()
+    progress = await ImportProgress.start(import_id)
+    resume_from = progress.checkpoint['processed']
+    id_prefix = progress.id_prefix
+    semaphore = asyncio.Semaphore(USER_IMPORT_CONCURRENCY)
+    tasks = []
+    errors = []
+    imported = 0
+
+    async def run_chunk(chunk: ImportChunk):
+        nonlocal imported
+        try:
+            chunk_imported = await _insert_chunk(chunk, id_prefix, hasher)
+        finally:
+            semaphore.release()
+        imported += chunk_imported
+        await progress.chunk_done(chunk, chunk_imported)
+
+    async def submit(chunk: ImportChunk):
+        await semaphore.acquire()
+        for task in tasks:
+            if task.done() and task.exception() is not None:
+                semaphore.release()
+                raise task.exception()
+        tasks[:] = [task for task in tasks if not task.done()]
+        tasks.append(asyncio.create_task(run_chunk(chunk)))
+
+    chunk = ImportChunk(0, resume_from)
+    try:
+        index = -1
+        async for item in items:
+            index += 1
+            if index < resume_from:
+                continue
+
+            chunk.end = index + 1
+            if item is INVALID_JSON:
+                errors.append(_row_error(index, "Invalid JSON"))
+                chunk.failed += 1
+            else:
+                try:
+                    chunk.users.append((index, User.model_validate(item)))
+                except ValidationError as error:
+                    errors.append(_row_error(index, error.errors()[0]['msg']))
+                    chunk.failed += 1
+
+            if chunk.end - chunk.start >= USER_IMPORT_CHUNK_SIZE:
+                await submit(chunk)
+                chunk = ImportChunk(chunk.number + 1, chunk.end)
+
+        if chunk.end > chunk.start:
+            await submit(chunk)
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    elapsed = perf_counter() - start
+    return {
+        'import_id': import_id,
+        'processed': progress.checkpoint['processed'],
+        'imported': progress.checkpoint['imported'],
+        'failed': progress.checkpoint['failed'],
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'users_per_second': round(imported / elapsed, 1) if elapsed else 0.0
+    }
+
+
+def _row_error(index: int, detail: str) -> dict:
+    return {'index': index, 'status_code': 422, 'detail': detail}
+
+
+async def _read_file(path: Path, chunk_size: int = 1 << 16):
+    with path.open('rb') as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+async def main(path: Path, import_id: str, hash_workers: int):
+    if path.suffix.lower() == '.csv':
+        items = iter_csv_items(_read_file(path))
+    else:
+        items = iter_ndjson_items(_read_file(path))
+
+    summary = await import_users(
+        items,
+        import_id,
+        PasswordHasher(hash_workers)
+    )
+    for error in summary['errors']:
+        print(f"row {error['index']}: {error['detail']}")
+    print(
+        f"{summary['import_id']}: {summary['processed']} rows processed, "
+        f"{summary['imported']} users imported, "
+        f"{summary['failed']} rows failed; this run took "
+        f"{summary['elapsed_seconds']} s, "
+        f"{summary['users_per_second']} users/s"
+    )
+    mongo.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import users from a CSV or NDJSON file.'
+    )
+    parser.add_argument('path', type=Path)
+    parser.add_argument(
+        '--import-id',
+        help='checkpoint name, the file name by default; run again with '
+             'the same name to resume an interrupted import'
+    )
+    parser.add_argument(
+        '--hash-workers',
+        type=int,
+        default=os.cpu_count(),
+        help='threads hashing passwords, one per CPU by default'
+    )
+    args = parser.parse_args()
+    asyncio.run(main(
+        args.path,
+        args.import_id or args.path.name,
+        args.hash_workers
+    ))
@@ -0,0 +1,120 @@
+'''
+Fire many checkouts in parallel against the same product and check that
+stock is never oversold: exactly as many checkouts as there were units
+in stock must succeed, every other one must fail for lack of stock, and
+the stock must end at zero. The carts are stored directly in the
+database, without holding their units in the reservations ledger, so it
+is the checkouts themselves that race for the stock. The API talks to
+the database configured in .env; everything the check creates is deleted
+at the end.
+
+Usage: python benchmarks/checkout_concurrency.py [--carts N] [--stock N]
+'''
+import argparse
+import asyncio
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import httpx
+from bson import ObjectId
+from api.db.settings import mongo
+from api.main import app
+
+OUT_OF_STOCK = "Some products don't have enough stock"
+
+
+def checkout_outcome(response: httpx.Response, product_id: str) -> str:
+    '''Classify a checkout response as succeeded, out of stock or other.'''
+    if response.status_code == 200:
+        return 'succeeded'
+    if response.status_code == 422 and response.json()['detail'] == {
+            'message': OUT_OF_STOCK,
+            'product_ids': [product_id]}:
+        return 'out of stock'
+    return f'{response.status_code} {response.text}'
+
+
+async def main(carts: int, stock: int) -> bool:
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(transport=transport, base_url='http://bench')
+    async with app.router.lifespan_context(app), client:
+        response = await client.post('/api/products/', json={
+            'name': 'Checkout concurrency check',
+            'theme': 'food',
+            'price': 1.0,
+            'quantity': stock
+        })
+        response.raise_for_status()
+        product_id = response.json()['id']
+
+        users = []
+        for index in range(carts):
+            response = await client.post('/api/users/', json={
+                'username': f'checkout-check-{index}',
+                'email': f'checkout-check-{index}@example.com',
+                'password': 'checkout-check'
+            })
+            response.raise_for_status()
+            users.append(response.json())
+
+        # Seeded carts hold nothing, so the reservations don't turn the
+        # extra carts away before they reach the checkout.
+        await mongo.shopping_carts_collection.insert_many([
+            {
+                '_id': ObjectId(user['shopping_cart_id']),
+                'user_id': ObjectId(user['id']),
+                'products': [{
+                    'product_id': ObjectId(product_id),
+                    'quantity': 1,
+                    'unit_price': 1.0
+                }],
+                'item_count': 1,
+                'subtotal': 1.0,
+                'version': 0
+            }
+            for user in users
+        ])
+
+        responses = await asyncio.gather(*(
+            client.post(
+                f"/api/shopping_carts/{user['shopping_cart_id']}/checkout"
+            )
+            for user in users
+        ))
+        outcomes = Counter(
+            checkout_outcome(response, product_id) for response in responses
+        )
+
+        response = await client.get(f'/api/products/{product_id}')
+        remaining_stock = response.json()['quantity']
+
+        await client.delete(f'/api/products/{product_id}')
+        for user in users:
+            await client.delete(f"/api/users/{user['id']}")
+
+    expected = min(carts, stock)
+    print(f'{carts} parallel checkouts of 1 unit, {stock} units in stock')
+    print(f'outcomes: {dict(outcomes)}')
+    print(f"succeeded: {outcomes['succeeded']} (expected {expected})")
+    print(
+        f"out of stock: {outcomes['out of stock']} "
+        f"(expected {carts - expected})"
+    )
+    print(f'remaining stock: {remaining_stock} (expected {stock - expected})')
+    return (
+        outcomes['succeeded'] == expected
+        and outcomes['out of stock'] == carts - expected
+        and remaining_stock == stock - expected
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--carts', type=int, default=200)
+    parser.add_argument('--stock', type=int, default=50)
+    args = parser.parse_args()
+    if not asyncio.run(main(args.carts, args.stock)):
+        sys.exit('Stock was oversold or undersold')
@@ -0,0 +1,310 @@
+'''
+Seed a database with users, products and shopping carts, then drive the
+API in-process through httpx and report the p50/p99 latency and the
+throughput of:
+
+- GET /api/products/ for every sort and filter combination of QueryParams
+- PATCH /api/shopping_carts/{id}/add_item with large payloads
+- DELETE /api/products/{id} and DELETE /api/users/{id} (cascade deletes)
+
+By default the API talks to a local mongod (--mongo-url), using its own
+database, which is dropped before and after the run. With --backend fake
+it runs against mongomock-motor instead (pip install -r
+benchmarks/requirements.txt), which needs no server but only measures
+the API side. Results can be saved as JSON and compared with a previous
+run, so regressions can be diffed between commits.
+
+Usage: python benchmarks/load.py [--backend mongo|fake] [--output FILE]
+                                 [--compare FILE] [--requests N] ...
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import httpx
+
+PRODUCT_THEMES = [
+    'drink', 'food', 'personal_care', 'health_care', 'cleaning'
+]
+SORTABLE_FIELDS = ['id', 'name', 'theme', 'price', 'quantity']
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    '''Nearest-rank percentile of an already sorted list.'''
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1)
+    }
+
+
+async def measure(requests: list, concurrency: int) -> dict:
+    '''
+    Run the given request factories with at most concurrency of them in
+    flight, and summarize their latency. A request fails when its
+    response is not a 2xx.
+    '''
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for request in pending:
+            start = time.perf_counter()
+            response = await request()
+            latencies.append(time.perf_counter() - start)
+            if not response.is_success:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def listing_scenarios(page_size: int) -> dict:
+    '''Query parameters of every sort and filter combination.'''
+    sorts = [None] + [
+        (field, descending)
+        for field in SORTABLE_FIELDS
+        for descending in (False, True)
+    ]
+    scenarios = {}
+    for apply_filter in (False, True):
+        for sort in sorts:
+            params = {'limit': page_size}
+            name = 'list'
+            if apply_filter:
+                params['apply_product_theme_filter'] = True
+                params['product_theme'] = 'food'
+                name += ' theme=food'
+            if sort is not None:
+                params['apply_product_attribute_sort'] = True
+                params['product_attribute_to_sort'] = sort[0]
+                params['descending'] = sort[1]
+                name += f" sort={'-' if sort[1] else ''}{sort[0]}"
+            scenarios[name] = params
+    return scenarios
+
+
+async def seed(client: httpx.AsyncClient, args) -> dict:
+    '''Create the products, users and filled carts used by the scenarios.'''
+    operations = [
+        {
+            'operation': 'create',
+            'product': {
+                'name': f'Product {index}',
+                'theme': PRODUCT_THEMES[index % len(PRODUCT_THEMES)],
+                'price': round((index % 997) * 1.37, 2),
+                'quantity': 1000 + index % 50
+            }
+        }
+        for index in range(args.products)
+    ]
+    response = await client.post('/api/products/bulk', json=operations)
+    response.raise_for_status()
+    product_ids = [result['id'] for result in response.json()]
+
+    users = []
+    for index in range(args.users):
+        response = await client.post('/api/users/', json={
+            'username': f'benchmark-{index}',
+            'email': f'benchmark-{index}@example.com',
+            'password': 'benchmark'
+        })
+        response.raise_for_status()
+        users.append(response.json())
+
+    # Half of the users get a filled cart, so the cascade deletes of
+    # products have carts to pull the products from.
+    cart_items = product_ids[:args.cart_items]
+    for user in users[::2]:
+        response = await client.patch(
+            f"/api/shopping_carts/{user['shopping_cart_id']}/add_item",
+            json=[
+                {'product_id': product_id, 'quantity': 1}
+                for product_id in cart_items
+            ]
+        )
+        response.raise_for_status()
+
+    return {'product_ids': product_ids, 'users': users}
+
+
+async def run_scenarios(client: httpx.AsyncClient, args) -> dict:
+    seeded = await seed(client, args)
+    product_ids = seeded['product_ids']
+    users = seeded['users']
+    results = {}
+
+    for name, params in listing_scenarios(args.page_size).items():
+        results[name] = await measure(
+            [
+                lambda params=params: client.get(
+                    '/api/products/',
+                    params=params
+                )
+                for _ in range(args.requests)
+            ],
+            args.concurrency
+        )
+        print(name, results[name])
+
+    # Every request adds a large payload of new lines to its own empty
+    # cart, so the half of the users without a filled cart are used.
+    payload = [
+        {'product_id': product_id, 'quantity': 1}
+        for product_id in product_ids[-args.cart_items:]
+    ]
+    empty_carts = [user['shopping_cart_id'] for user in users[1::2]]
+    name = f'add_item {len(payload)} lines'
+    results[name] = await measure(
+        [
+            lambda id=id: client.patch(
+                f'/api/shopping_carts/{id}/add_item',
+                json=payload
+            )
+            for id in empty_carts[:args.requests]
+        ],
+        args.concurrency
+    )
+    print(name, results[name])
+
+    # Products from the start of the list are in half of the carts.
+    deleted_products = product_ids[:min(args.requests, len(product_ids))]
+    name = 'delete product cascade'
+    results[name] = await measure(
+        [
+            lambda id=id: client.delete(f'/api/products/{id}')
+            for id in deleted_products
+        ],
+        args.concurrency
+    )
+    print(name, results[name])
+
+    name = 'delete user cascade'
+    results[name] = await measure(
+        [
+            lambda id=user['id']: client.delete(f'/api/users/{id}')
+            for user in users[:args.requests]
+        ],
+        args.concurrency
+    )
+    print(name, results[name])
+
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: dict, results: dict):
+    '''Print the change of p50, p99 and throughput against a saved run.'''
+    print(f"\nCompared with {previous['meta'].get('commit')}:")
+    for name, result in results.items():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps'):
+            change = (result[key] - before[key]) / before[key] * 100
+            changes.append(f'{key} {change:+.1f}%')
+        print(f"{name}: {', '.join(changes)}")
+
+
+async def main(args):
+    os.environ['MONGO_DB_NAME'] = args.database
+    if args.backend == 'mongo':
+        os.environ['MONGO_DB_URL'] = args.mongo_url
+
+    from api.db.settings import mongo
+    from api.main import app
+
+    if args.backend == 'fake':
+        from mongomock_motor import AsyncMongoMockClient
+        mongo.connect(AsyncMongoMockClient())
+
+    await mongo.client.drop_database(args.database)
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(
+        transport=transport,
+        base_url='http://bench',
+        timeout=None
+    )
+    try:
+        async with app.router.lifespan_context(app), client:
+            results = await run_scenarios(client, args)
+    finally:
+        if args.backend == 'mongo':
+            await mongo.client.drop_database(args.database)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'backend': args.backend,
+            'python': platform.python_version(),
+            'parameters': {
+                key: getattr(args, key) for key in (
+                    'products', 'users', 'cart_items', 'page_size',
+                    'requests', 'concurrency'
+                )
+            }
+        },
+        'results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backend', choices=['mongo', 'fake'],
+                        default='mongo')
+    parser.add_argument('--mongo-url', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='ecommerce_benchmark')
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--cart-items', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', type=Path)
+    args = parser.parse_args()
+
+    if args.database == 'ecommerce_db':
+        parser.error('the benchmark database is dropped, use another one')
+
+    report = asyncio.run(main(args))
+
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report['results'])
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + '\n')
@@ -0,0 +1,99 @@
+'''
+Check that a burst of signups doesn't stall the other requests. While
+a burst of requests hashes passwords, a cheap endpoint is probed at a
+steady rate and its latency is reported, once with the hashing done on
+the event loop and once with the thread pool used by the API
+(PasswordHasher). The database is left out: only the hashing differs.
+
+Usage: python benchmarks/password_hashing.py [--signups N] [--probes N]
+'''
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import httpx
+from fastapi import FastAPI
+from api.constants import PASSWORD_HASH_WORKERS
+from api.passwords import PasswordHasher, hash_password_sync
+
+
+def build_app(offload: bool) -> FastAPI:
+    app = FastAPI()
+    hasher = PasswordHasher(PASSWORD_HASH_WORKERS)
+
+    @app.post('/signup')
+    async def signup():
+        if offload:
+            await hasher.hash('benchmark-password')
+        else:
+            hash_password_sync('benchmark-password')
+        return {}
+
+    @app.get('/ping')
+    async def ping():
+        return {}
+
+    return app
+
+
+async def probe_during_burst(
+        app: FastAPI,
+        signups: int,
+        probes: int,
+        interval: float) -> list:
+    '''
+    Latencies of /ping, probed every interval during the burst. Each
+    latency is measured from the time its probe was due, so the time a
+    probe waits for a blocked event loop counts as well.
+    '''
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+            transport=transport,
+            base_url='http://bench') as client:
+        burst = asyncio.gather(*(
+            client.post('/signup') for _ in range(signups)
+        ))
+        latencies = []
+        start = time.perf_counter()
+        for index in range(probes):
+            due = start + index * interval
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            await client.get('/ping')
+            latencies.append(time.perf_counter() - due)
+        await burst
+
+    return sorted(latencies)
+
+
+def report(name: str, latencies: list):
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    worst = latencies[-1] * 1000
+    print(
+        f'{name}: /ping p50 {p50:.2f} ms, p99 {p99:.2f} ms, '
+        f'max {worst:.2f} ms'
+    )
+
+
+def main(signups: int, probes: int, interval: float):
+    for name, offload in (('event loop', False), ('thread pool', True)):
+        latencies = asyncio.run(probe_during_burst(
+            build_app(offload),
+            signups,
+            probes,
+            interval
+        ))
+        report(name, latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--signups', type=int, default=50)
+    parser.add_argument('--probes', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=0.01)
+    args = parser.parse_args()
+    main(args.signups, args.probes, args.interval)
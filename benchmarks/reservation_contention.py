@@ -0,0 +1,102 @@
+'''
+Fire many add_item requests in parallel at the same product, so every
+request races for the reserved counter of one hot document, and report
+their latency and throughput. Afterwards, check that no unit was held
+twice: exactly as many carts as there were units in stock must hold one,
+and the reserved counter of the product must match the reservations
+ledger. The API talks to the database configured in .env; everything the
+check creates is deleted at the end.
+
+Usage: python benchmarks/reservation_contention.py [--carts N] [--stock N]
+'''
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import httpx
+from bson import ObjectId
+from api.db.settings import mongo
+from api.main import app
+
+
+async def add_item(client: httpx.AsyncClient, user: dict, product_id: str):
+    start = time.perf_counter()
+    response = await client.patch(
+        f"/api/shopping_carts/{user['shopping_cart_id']}/add_item",
+        json=[{'product_id': product_id, 'quantity': 1}]
+    )
+    return response.status_code, time.perf_counter() - start
+
+
+async def main(carts: int, stock: int) -> bool:
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(transport=transport, base_url='http://bench')
+    async with app.router.lifespan_context(app), client:
+        response = await client.post('/api/products/', json={
+            'name': 'Reservation contention check',
+            'theme': 'food',
+            'price': 1.0,
+            'quantity': stock
+        })
+        product_id = response.json()['id']
+
+        users = []
+        for index in range(carts):
+            response = await client.post('/api/users/', json={
+                'username': f'reservation-check-{index}',
+                'email': f'reservation-check-{index}@example.com',
+                'password': 'reservation-check'
+            })
+            users.append(response.json())
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            add_item(client, user, product_id) for user in users
+        ))
+        elapsed = time.perf_counter() - start
+
+        product = await mongo.products_collection.find_one(
+            {'_id': ObjectId(product_id)}
+        )
+        reserved = product.get('reserved', 0)
+        ledger = await mongo.reservations_collection.aggregate([
+            {'$match': {'product_id': ObjectId(product_id)}},
+            {'$group': {'_id': None, 'quantity': {'$sum': '$quantity'}}}
+        ]).to_list(length=1)
+        held = ledger[0]['quantity'] if ledger else 0
+
+        await client.delete(f'/api/products/{product_id}')
+        for user in users:
+            await client.delete(f"/api/users/{user['id']}")
+
+    status_codes = Counter(status_code for status_code, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+    expected = min(carts, stock)
+    print(f'{carts} parallel add_item of 1 unit, {stock} units in stock')
+    print(
+        f'p50 {p50:.2f} ms, p99 {p99:.2f} ms, '
+        f'{len(latencies) / elapsed:.1f} requests/s'
+    )
+    print(f'status codes: {dict(status_codes)}')
+    print(f'succeeded: {status_codes[200]} (expected {expected})')
+    print(f'reserved: {reserved}, held in the ledger: {held}')
+    return (
+        status_codes[200] == expected
+        and reserved == held == expected
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--carts', type=int, default=500)
+    parser.add_argument('--stock', type=int, default=100)
+    args = parser.parse_args()
+    if not asyncio.run(main(args.carts, args.stock)):
+        sys.exit('Stock was held twice or the ledger is out of sync')
@@ -0,0 +1,37 @@
+'''
+The tests drive the API in-process against mongomock-motor, an in-memory
+stand-in for MongoDB, with a fresh database for every test.
+'''
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from api.db.cache import products_cache
+from api.db.settings import mongo
+from api.main import app
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def database():
+    mongo.connect(AsyncMongoMockClient())
+    products_cache.clear()
+    yield mongo.db
+    mongo.close()
+
+
+@pytest.fixture
+async def client(database):
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(transport=transport, base_url='http://test')
+    async with app.router.lifespan_context(app), client:
+        yield client
+
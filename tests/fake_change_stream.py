@@ -0,0 +1,69 @@
+import asyncio
+
+
+class FakeChangeStream:
+    '''
+    Change stream replaying the events of a FakeChangeStreamDatabase
+    which come after a resume token, then waiting for more like a real
+    stream does.
+    '''
+
+    def __init__(self, database, collections: list, resume_after):
+        self.database = database
+        self.collections = collections
+        self.position = database.position_after(resume_after)
+        self.resume_token = resume_after
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            while self.position < len(self.database.events):
+                token, change = self.database.events[self.position]
+                self.position += 1
+                self.resume_token = token
+                if change['ns']['coll'] in self.collections:
+                    return change
+            self.database.drained.set()
+            await self.database.new_event.wait()
+
+
+class FakeChangeStreamDatabase:
+    '''
+    Stands in for the Motor database given to watch_cache_invalidations.
+    Events are appended with emit() and each gets a resume token, and
+    the resume tokens streams were opened with are kept in resumed_after.
+    Only the $match on ns.coll built by the watcher is understood.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self.resumed_after = []
+        self.drained = asyncio.Event()
+        self.new_event = asyncio.Event()
+
+    def emit(self, operation: str, collection: str, document_id=None):
+        change = {'operationType': operation, 'ns': {'coll': collection}}
+        if document_id is not None:
+            change['documentKey'] = {'_id': document_id}
+        self.events.append(({'_data': str(len(self.events))}, change))
+        self.drained.clear()
+        self.new_event.set()
+        self.new_event = asyncio.Event()
+
+    def position_after(self, resume_token) -> int:
+        if resume_token is None:
+            return len(self.events)
+        return int(resume_token['_data']) + 1
+
+    def watch(self, pipeline: list, resume_after=None) -> FakeChangeStream:
+        self.resumed_after.append(resume_after)
+        collections = pipeline[0]['$match']['ns.coll']['$in']
+        return FakeChangeStream(self, collections, resume_after)
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+from api.db.cache import AsyncLRUCache
+from api.db.change_streams import (
+    MongoResumeTokenStore,
+    watch_cache_invalidations
+)
+from tests.fake_change_stream import FakeChangeStreamDatabase
+
+pytestmark = pytest.mark.anyio
+
+
+async def load_products(keys: list) -> dict:
+    return {key: {'name': f'Product {key}'} for key in keys}
+
+
+async def cached_keys(cache: AsyncLRUCache, keys: list) -> set:
+    '''Keys of the given ones which are cached, without loading any.'''
+    misses = set()
+
+    async def record_misses(keys: list) -> dict:
+        misses.update(keys)
+        return await load_products(keys)
+
+    for key in keys:
+        await cache.get(key, record_misses)
+    return set(keys) - misses
+
+
+async def watch(fake_db, caches, token_store, changes: list = ()):
+    '''
+    Run the watcher until it has caught up, emit the given changes while
+    it runs, and stop it once it has processed them.
+    '''
+    watcher = asyncio.ensure_future(watch_cache_invalidations(
+        fake_db,
+        caches,
+        token_store,
+        save_interval_seconds=0
+    ))
+    await asyncio.wait_for(fake_db.drained.wait(), timeout=1)
+    for change in changes:
+        fake_db.emit(*change)
+    await asyncio.wait_for(fake_db.drained.wait(), timeout=1)
+    watcher.cancel()
+    await asyncio.gather(watcher, return_exceptions=True)
+
+
+async def test_changes_evict_cached_products_and_resume(database):
+    fake_db = FakeChangeStreamDatabase()
+    cache = AsyncLRUCache(100, 60)
+    caches = {'products_data': cache}
+    tokens = database['change_stream_tokens']
+    await cache.get_many(['a', 'b', 'c'], load_products)
+
+    await watch(fake_db, caches, MongoResumeTokenStore(tokens, 'products'), [
+        ('update', 'products_data', 'a'),
+        ('delete', 'products_data', 'b'),
+        ('update', 'users_data', 'c')
+    ])
+
+    assert await cached_keys(cache, ['a', 'b', 'c']) == {'c'}
+    saved = await tokens.find_one({'_id': 'products'})
+    assert saved['token'] == {'_data': '1'}
+
+    # Changes made while no stream was open are replayed on resume.
+    fake_db.emit('update', 'products_data', 'c')
+    await watch(fake_db, caches, MongoResumeTokenStore(tokens, 'products'))
+
+    assert fake_db.resumed_after == [None, {'_data': '1'}]
+    assert await cached_keys(cache, ['a', 'b', 'c']) == {'a', 'b'}
+    saved = await tokens.find_one({'_id': 'products'})
+    assert saved['token'] == {'_data': '3'}
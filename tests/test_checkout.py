@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from bson import ObjectId
+from api.db.settings import mongo
+from tests.utils import create_product, create_user
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_checkouts_never_oversell(client):
+    stock = 5
+    product = await create_product(client, quantity=stock)
+    users = [
+        await create_user(client, f'buyer-{index}') for index in range(20)
+    ]
+    # The carts hold no reservations, so the checkouts race for the stock.
+    await mongo.shopping_carts_collection.insert_many([
+        {
+            '_id': ObjectId(user['shopping_cart_id']),
+            'user_id': ObjectId(user['id']),
+            'products': [{
+                'product_id': ObjectId(product['id']),
+                'quantity': 1,
+                'unit_price': 1.0
+            }],
+            'item_count': 1,
+            'subtotal': 1.0,
+            'version': 0
+        }
+        for user in users
+    ])
+
+    responses = await asyncio.gather(*(
+        client.post(f"/api/shopping_carts/{user['shopping_cart_id']}/checkout")
+        for user in users
+    ))
+
+    succeeded = [
+        response for response in responses if response.status_code == 200
+    ]
+    assert len(succeeded) == stock
+    for response in responses:
+        if response.status_code != 200:
+            assert response.status_code == 422
+            assert response.json()['detail']['product_ids'] == [product['id']]
+
+    product_doc = await mongo.products_collection.find_one(
+        {'_id': ObjectId(product['id'])}
+    )
+    assert product_doc['quantity'] == 0
+    assert product_doc.get('reserved', 0) == 0
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from api import idempotency
+from api.db.settings import mongo
+from api.idempotency import IdempotencyStore, StoredResponse
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_long_request_keeps_its_lock(database, monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_LOCK_SECONDS', 0.2)
+    # Two stores stand for two workers sharing the database.
+    first_worker = IdempotencyStore(10)
+    second_worker = IdempotencyStore(10)
+    runs = 0
+
+    async def execute():
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(1)
+        return StoredResponse(201, [], b'created')
+
+    first = asyncio.ensure_future(first_worker.run('key', 'post', execute))
+    await asyncio.sleep(0.05)
+    response, replayed = await second_worker.run('key', 'post', execute)
+
+    assert runs == 1
+    assert replayed
+    assert response.body == b'created'
+    assert (await first)[1] is False
+
+
+async def test_large_body_is_refused(client, monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_MAX_BODY_BYTES', 64)
+
+    response = await client.post(
+        '/api/products/',
+        headers={'Idempotency-Key': 'large'},
+        json={
+            'name': 'x' * 64,
+            'theme': 'food',
+            'price': 1.0,
+            'quantity': 1
+        }
+    )
+
+    assert response.status_code == 413
+    assert await mongo.products_collection.count_documents({}) == 0
+
+
+async def test_streaming_endpoints_ignore_the_key(client):
+    operations = [{
+        'operation': 'create',
+        'product': {
+            'name': 'Streamed',
+            'theme': 'food',
+            'price': 1.0,
+            'quantity': 1
+        }
+    }]
+
+    for _ in range(2):
+        response = await client.post(
+            '/api/products/bulk',
+            headers={'Idempotency-Key': 'bulk'},
+            json=operations
+        )
+        assert response.status_code == 200
+        assert 'idempotent-replayed' not in response.headers
+
+    assert await mongo.products_collection.count_documents({}) == 2
+    assert await mongo.idempotency_keys_collection.count_documents({}) == 0
@@ -0,0 +1,25 @@
+import pytest
+from tests.utils import create_product
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_background_delete_answers_with_job(client):
+    product = await create_product(client)
+
+    response = await client.delete(
+        f"/api/products/{product['id']}",
+        params={'background': 'true'}
+    )
+    assert response.status_code == 202
+    job_id = response.json()['job_id']
+
+    response = await client.get(f'/api/jobs/{job_id}')
+    assert response.status_code == 200
+
+    response = await client.get('/openapi.json')
+    delete = response.json()['paths']['/api/products/{product_id}']['delete']
+    content = delete['responses']['202']['content']
+    assert content['application/json']['schema'] == {
+        '$ref': '#/components/schemas/CreateJobOutput'
+    }
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from bson import ObjectId
+from api.db.indexes import ensure_indexes
+from api.db.reservations import (
+    CLAIM_TIMEOUT_SECONDS,
+    reconcile_reserved_counters,
+    release_carts,
+    sweep_expired_reservations
+)
+from api.db.settings import mongo
+from tests.utils import create_product, create_user
+
+pytestmark = pytest.mark.anyio
+
+
+async def reserved_units(product: dict) -> int:
+    product_doc = await mongo.products_collection.find_one(
+        {'_id': ObjectId(product['id'])}
+    )
+    return product_doc.get('reserved', 0)
+
+
+async def fill_cart(client, user: dict, products: list, quantity: int = 1):
+    response = await client.patch(
+        f"/api/shopping_carts/{user['shopping_cart_id']}/add_item",
+        json=[
+            {'product_id': product['id'], 'quantity': quantity}
+            for product in products
+        ]
+    )
+    assert response.status_code == 200
+
+
+async def test_clear_cart_releases_every_hold(client):
+    products = [await create_product(client) for _ in range(3)]
+    user = await create_user(client, 'shopper')
+    await fill_cart(client, user, products, quantity=2)
+    assert [await reserved_units(product) for product in products] == [2] * 3
+
+    response = await client.patch(
+        f"/api/shopping_carts/{user['shopping_cart_id']}/clear"
+    )
+    assert response.status_code == 200
+
+    assert [await reserved_units(product) for product in products] == [0] * 3
+    assert await mongo.reservations_collection.count_documents({}) == 0
+
+
+async def test_release_carts_together(client):
+    product = await create_product(client)
+    users = [await create_user(client, f'shopper-{index}') for index in (1, 2)]
+    for user in users:
+        await fill_cart(client, user, [product])
+
+    await release_carts([ObjectId(user['shopping_cart_id']) for user in users])
+
+    assert await reserved_units(product) == 0
+    assert await mongo.reservations_collection.count_documents({}) == 0
+
+
+async def test_sweep_releases_expired_and_abandoned_claims(client):
+    product = await create_product(client)
+    users = [
+        await create_user(client, f'shopper-{index}') for index in range(3)
+    ]
+    for user in users:
+        await fill_cart(client, user, [product])
+    expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+    carts = [ObjectId(user['shopping_cart_id']) for user in users]
+    await mongo.reservations_collection.update_many(
+        {'cart_id': {'$in': carts[:2]}},
+        {'$set': {'expires_at': expired}}
+    )
+    # A claimer died after stamping the first hold, long ago.
+    abandoned_claim = ObjectId.from_datetime(
+        datetime.now(timezone.utc)
+        - timedelta(seconds=CLAIM_TIMEOUT_SECONDS + 1)
+    )
+    await mongo.reservations_collection.update_one(
+        {'cart_id': carts[0]},
+        {'$set': {'claim': abandoned_claim}}
+    )
+
+    assert await sweep_expired_reservations() == 2
+
+    assert await reserved_units(product) == 1
+    remaining = await mongo.reservations_collection.find().to_list(None)
+    assert [reservation['cart_id'] for reservation in remaining] == [carts[2]]
+
+
+async def test_reconcile_corrects_lasting_drifts(client):
+    product = await create_product(client)
+    user = await create_user(client, 'shopper')
+    await fill_cart(client, user, [product], quantity=2)
+    product_id = ObjectId(product['id'])
+    # A worker died after raising the counter, before writing the ledger.
+    await mongo.products_collection.update_one(
+        {'_id': product_id},
+        {'$inc': {'reserved': 3}}
+    )
+
+    drifts = await reconcile_reserved_counters({})
+    assert drifts == {product_id: (5, 3)}
+    assert await reserved_units(product) == 5
+
+    assert await reconcile_reserved_counters(drifts) == {}
+    assert await reserved_units(product) == 2
+
+
+async def test_reconcile_skips_moving_counters(client):
+    product = await create_product(client)
+    user = await create_user(client, 'shopper')
+    product_id = ObjectId(product['id'])
+    await mongo.products_collection.update_one(
+        {'_id': product_id},
+        {'$inc': {'reserved': 1}}
+    )
+    drifts = await reconcile_reserved_counters({})
+
+    # The write in flight lands in the ledger, and another cart reserves.
+    await mongo.reservations_collection.insert_one({
+        'cart_id': ObjectId(user['shopping_cart_id']),
+        'product_id': product_id,
+        'quantity': 1
+    })
+    await fill_cart(client, user, [product])
+
+    assert await reconcile_reserved_counters(drifts) == {}
+    assert await reserved_units(product) == 2
+
+
+async def test_ensure_indexes_drops_reservation_ttl_index(database):
+    await database['reservations_data'].create_index(
+        'expires_at',
+        expireAfterSeconds=3600
+    )
+
+    await ensure_indexes(database)
+
+    indexes = await database['reservations_data'].index_information()
+    assert 'expires_at_1' not in indexes
+    assert 'expireAfterSeconds' not in indexes['expires_at_sweep']
@@ -0,0 +1,61 @@
+import pytest
+from bson import ObjectId
+from api.db.cart_actions import apply_cart_changes, lazy_cart
+from api.db.settings import mongo
+from tests.utils import create_product, create_user
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('products_data', [
+    [],
+    [{'product_id': None, 'quantity': 0}]
+])
+async def test_add_nothing_to_lazy_cart(client, products_data):
+    product = await create_product(client)
+    user = await create_user(client, 'lazy')
+    cart_id = user['shopping_cart_id']
+    products_data = [
+        {**line, 'product_id': product['id']} for line in products_data
+    ]
+
+    response = await client.patch(
+        f'/api/shopping_carts/{cart_id}/add_item',
+        json=products_data
+    )
+    assert response.status_code == 200
+    assert await mongo.shopping_carts_collection.count_documents({}) == 0
+
+    for path in ('', '/view'):
+        response = await client.get(f'/api/shopping_carts/{cart_id}{path}')
+        assert response.status_code == 200
+
+    response = await client.patch(
+        f'/api/shopping_carts/{cart_id}/add_item',
+        json=[{'product_id': product['id'], 'quantity': 2}]
+    )
+    assert response.status_code == 200
+    response = await client.get(f'/api/shopping_carts/{cart_id}')
+    assert response.json()['item_count'] == 2
+
+
+async def test_mixed_changes_store_lazy_cart(database):
+    user_id = ObjectId()
+    kept_id, new_id = ObjectId(), ObjectId()
+    shopping_cart = lazy_cart(user_id)
+    shopping_cart['products'] = [
+        {'product_id': kept_id, 'quantity': 1, 'unit_price': 2.0}
+    ]
+
+    updated_cart = await apply_cart_changes(
+        mongo.shopping_carts_collection,
+        shopping_cart,
+        {kept_id: 1, new_id: 1},
+        {new_id: 3.0}
+    )
+
+    assert updated_cart['_id'] == user_id
+    assert updated_cart['user_id'] == user_id
+    assert [line['product_id'] for line in updated_cart['products']] == [
+        new_id
+    ]
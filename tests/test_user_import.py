@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+from api import user_import
+from api.db.settings import mongo
+from api.passwords import password_hasher
+from api.user_import import ImportChunk, ImportProgress, import_users
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeHasher:
+    '''Hashes instantly.'''
+
+    async def hash(self, password: str) -> str:
+        return f'hashed-{password}'
+
+
+def user_rows(count: int) -> list:
+    return [
+        {
+            'username': f'imported-{index}',
+            'email': f'imported-{index}@example.com',
+            'password': 'password'
+        }
+        for index in range(count)
+    ]
+
+
+async def iter_rows(rows: list, fail_at: int = None):
+    for index, row in enumerate(rows):
+        # Rows arrive over the network, letting the chunks run meanwhile.
+        await asyncio.sleep(0.01)
+        if index == fail_at:
+            raise ConnectionError('client went away')
+        yield row
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(user_import, 'USER_IMPORT_CHUNK_SIZE', 2)
+
+
+def test_imports_hash_apart_from_requests():
+    assert user_import.import_password_hasher is not password_hasher
+    assert (
+        user_import.import_password_hasher.executor
+        is not password_hasher.executor
+    )
+
+
+async def test_checkpoint_waits_for_earlier_chunks(database):
+    progress = await ImportProgress.start('out-of-order')
+    chunks = [ImportChunk(number, number * 2) for number in range(3)]
+    for chunk in chunks:
+        chunk.end = chunk.start + 2
+    chunks[1].failed = 1
+
+    await progress.chunk_done(chunks[2], 2)
+    await progress.chunk_done(chunks[1], 1)
+    assert progress.checkpoint['processed'] == 0
+    assert progress.checkpoint['imported'] == 3
+    assert progress.checkpoint['failed'] == 0
+
+    await progress.chunk_done(chunks[0], 2)
+    assert progress.checkpoint['processed'] == 6
+    assert progress.checkpoint['imported'] == 5
+    assert progress.checkpoint['failed'] == 1
+
+    resumed = await ImportProgress.start('out-of-order')
+    assert resumed.checkpoint['processed'] == 6
+    assert resumed.id_prefix == progress.id_prefix
+
+
+async def test_rerun_resumes_without_duplicates(database, small_chunks):
+    rows = user_rows(7)
+    del rows[3]['password']
+
+    with pytest.raises(ConnectionError):
+        await import_users(
+            iter_rows(rows, fail_at=5),
+            'resumed',
+            FakeHasher()
+        )
+    checkpoint = await mongo.user_imports_collection.find_one(
+        {'_id': 'resumed'}
+    )
+    assert 0 < checkpoint['processed'] <= 4
+
+    summary = await import_users(iter_rows(rows), 'resumed', FakeHasher())
+
+    assert summary['processed'] == 7
+    assert summary['imported'] == 6
+    assert summary['failed'] == 1
+    usernames = await mongo.users_collection.distinct('username')
+    assert sorted(usernames) == sorted(
+        row['username'] for index, row in enumerate(rows) if index != 3
+    )
+    assert await mongo.users_collection.count_documents({}) == 6
+
+    summary = await import_users(iter_rows(rows), 'resumed', FakeHasher())
+    assert summary['imported'] == 6
+    assert await mongo.users_collection.count_documents({}) == 6
@@ -0,0 +1,48 @@
+import pytest
+from bson import ObjectId
+from api.passwords import password_hasher
+from tests.utils import create_user
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def hashed_passwords(monkeypatch):
+    '''Passwords hashed while the fixture is in use.'''
+    passwords = []
+
+    async def hash(password: str) -> str:
+        passwords.append(password)
+        return f'hashed-{password}'
+
+    monkeypatch.setattr(password_hasher, 'hash', hash)
+    return passwords
+
+
+@pytest.mark.parametrize('user_id', ['not-an-id', str(ObjectId())])
+async def test_update_unknown_user_skips_hashing(
+        client, hashed_passwords, user_id):
+    response = await client.put(f'/api/users/{user_id}', json={
+        'username': 'unknown',
+        'email': 'unknown@example.com',
+        'password': 'new-password'
+    })
+    assert response.status_code == 404
+
+    response = await client.patch(
+        f'/api/users/{user_id}',
+        json={'password': 'new-password'}
+    )
+    assert response.status_code == 404
+    assert hashed_passwords == []
+
+
+async def test_update_user_password(client, hashed_passwords):
+    user = await create_user(client, 'known')
+
+    response = await client.patch(
+        f"/api/users/{user['id']}",
+        json={'password': 'new-password'}
+    )
+    assert response.status_code == 200
+    assert hashed_passwords[-1] == 'new-password'
@@ -0,0 +1,23 @@
+import httpx
+
+
+async def create_product(client: httpx.AsyncClient, **fields) -> dict:
+    response = await client.post('/api/products/', json={
+        'name': 'Product',
+        'theme': 'food',
+        'price': 1.0,
+        'quantity': 10,
+        **fields
+    })
+    assert response.status_code == 201
+    return response.json()
+
+
+async def create_user(client: httpx.AsyncClient, username: str) -> dict:
+    response = await client.post('/api/users/', json={
+        'username': username,
+        'email': f'{username}@example.com',
+        'password': 'password'
+    })
+    assert response.status_code == 201
+    return response.json()